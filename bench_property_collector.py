@@ -0,0 +1,124 @@
+from pyVmomi import vim, vmodl
+from sync import Sync
+import argparse
+import time
+
+
+###################################
+#      Fake ESXi Service Stub     #
+###################################
+# Answers pyVmomi calls from memory and counts them - every InvokeMethod / InvokeAccessor is one SOAP round trip
+class FakeStub():
+    def __init__(self, vm_count, latency):
+        self.latency = latency
+        self.round_trips = 0
+        self.tokens = {}
+        self.vms = {
+            f"vm-{i}": {
+                "name": f"vm-{i:05d}",
+                "config.uuid": f"4200{i:04x}-0000-0000-0000-{i:012x}",
+                "guest.hostName": f"guest-{i}.local" if i % 5 else None,
+                "guest.ipAddress": f"10.0.{i // 250}.{i % 250}" if i % 5 else None,
+                "guest.toolsStatus": "toolsOk" if i % 3 else "toolsNotRunning",
+                "runtime.powerState": "poweredOn" if i % 4 else "poweredOff"
+            }
+            for i in range(vm_count)
+        }
+
+    def round_trip(self):
+        self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def InvokeAccessor(self, mo, info):
+        self.round_trip()
+        if isinstance(mo, vim.view.ContainerView) and info.name == "view":
+            return [vim.VirtualMachine(moid, self) for moid in self.vms]
+
+        properties = self.vms[mo._moId]
+        if info.name == "name":
+            return properties["name"]
+        if info.name == "config":
+            return vim.vm.ConfigInfo(uuid=properties["config.uuid"])
+        if info.name == "guest":
+            return vim.vm.GuestInfo(
+                hostName=properties["guest.hostName"],
+                ipAddress=properties["guest.ipAddress"],
+                toolsStatus=properties["guest.toolsStatus"]
+            )
+        if info.name == "runtime":
+            return vim.vm.RuntimeInfo(powerState=properties["runtime.powerState"])
+        raise NotImplementedError(f"Fake stub has no property {info.name}")
+
+    def InvokeMethod(self, mo, info, args):
+        self.round_trip()
+        if info.name == "CreateContainerView":
+            return vim.view.ContainerView("session[bench]view-1", self)
+        if info.name == "Destroy":
+            return None
+        if info.name == "RetrievePropertiesEx":
+            filter_spec, options = args[0][0], args[1]
+            return self.page(list(self.vms), filter_spec.propSet[0].pathSet, options.maxObjects)
+        if info.name == "ContinueRetrievePropertiesEx":
+            return self.page(*self.tokens.pop(args[0]))
+        raise NotImplementedError(f"Fake stub has no method {info.name}")
+
+    def page(self, moids, path_set, page_size):
+        token = None
+        if len(moids) > page_size:
+            token = f"token-{len(self.tokens) + 1}"
+            self.tokens[token] = (moids[page_size:], path_set, page_size)
+        objects = [
+            vmodl.query.PropertyCollector.ObjectContent(
+                obj=vim.VirtualMachine(moid, self),
+                propSet=[vmodl.DynamicProperty(name=path, val=self.vms[moid][path]) for path in path_set]
+            )
+            for moid in moids[:page_size]
+        ]
+        return vmodl.query.PropertyCollector.RetrieveResult(token=token, objects=objects)
+
+
+class FakeContent():
+    def __init__(self, stub):
+        self.rootFolder = vim.Folder("group-d1", stub)
+        self.viewManager = vim.view.ViewManager("ViewManager", stub)
+        self.propertyCollector = vmodl.query.PropertyCollector("propertyCollector", stub)
+
+
+###################################
+#            Benchmark            #
+###################################
+
+def comparable(vms):
+    # last_sync_time differs between runs
+    return sorted((tuple(sorted((key, value) for key, value in vm.items() if key != "last_sync_time")) for vm in vms))
+
+def run(collect, stub):
+    content = FakeContent(stub)
+    stub.round_trips = 0
+    start_time = time.perf_counter()
+    vms = collect(content)
+    return vms, stub.round_trips, time.perf_counter() - start_time
+
+def main():
+    parser = argparse.ArgumentParser(description="Round trips and time of the legacy VM walk vs the PropertyCollector collection")
+    parser.add_argument("--vms", type=int, nargs="+", default=[50, 500, 2000], help="VM counts of the fake host")
+    parser.add_argument("--latency", type=float, default=0.001, help="Seconds added to every fake round trip")
+    parser.add_argument("--page-size", type=int, default=500, help="page_size of the bulk collection")
+    args = parser.parse_args()
+
+    sync = Sync({"host": "bench", "port": 443, "username": "bench", "password": "bench", "page_size": args.page_size}, None, None, None, None)
+    print(f"{'vms':>6} {'mode':>7} {'round trips':>12} {'seconds':>9}")
+    for vm_count in args.vms:
+        stub = FakeStub(vm_count, args.latency)
+        legacy, legacy_trips, legacy_time = run(sync.walk_vms, stub)
+        bulk, bulk_trips, bulk_time = run(sync.collect_vms, stub)
+        if comparable(legacy) != comparable(bulk):
+            raise SystemExit(f"[ERROR] legacy and bulk collections differ for {vm_count} VMs")
+        print(f"{vm_count:>6} {'legacy':>7} {legacy_trips:>12} {legacy_time:>9.3f}")
+        print(f"{vm_count:>6} {'bulk':>7} {bulk_trips:>12} {bulk_time:>9.3f}")
+    sync.executor.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+from redis_client import RedisClient
+from session_codec import msgpack
+import argparse
+import asyncio
+import statistics
+import json
+import time
+
+
+###################################
+#            Sessions             #
+###################################
+# Run against a scratch Redis: the bench writes sessions under --key-prefix and deletes them afterwards
+
+def make_session(session_id, vm_count, orphan_count):
+    # Shaped like the sessions of the consuming services - the sweep only changes vms and orphans
+    return {
+        "user": f"operator-{session_id}@example.com",
+        "uid": 18446744073709551,
+        "token": "a" * 64,
+        "roles": ["viewer", "operator"],
+        "preferences": {"theme": "dark", "page_size": 50, "filters": []},
+        "created_at": 1760000000.123456,
+        "vms": [f"bench-vm-{i:05d}" for i in range(vm_count)],
+        "orphans": [{"name": f"bench-orphan-{i:05d}", "orphan_since": "2025-10-09 12:00:00"} for i in range(orphan_count)]
+    }
+
+def encode(session, session_format):
+    return msgpack.packb(session, use_bin_type=True) if session_format == "msgpack" else json.dumps(session)
+
+def sweep_changes(vm_count, orphan_count):
+    # What one cycle hands the sweep: 10% of the VMs orphaned, half the orphans back online, 2% renamed
+    orphans = {f"bench-vm-{i:05d}": {"name": f"bench-vm-{i:05d}", "orphan_since": "2025-10-10 08:00:00"} for i in range(0, vm_count, 10)}
+    reactivated = [f"bench-orphan-{i:05d}" for i in range(0, orphan_count, 2)]
+    renames = {f"bench-vm-{i:05d}": f"bench-vm-{i:05d}-renamed" for i in range(1, vm_count, 50)}
+    return orphans, reactivated, renames
+
+
+###################################
+#            Benchmark            #
+###################################
+
+async def write_sessions(redis_instance, keys, session_format, vm_count, orphan_count):
+    async with redis_instance.client.pipeline(transaction=False) as pipe:
+        for key in keys:
+            session = make_session(key, vm_count, orphan_count)
+            pipe.set(key, encode(session, session_format), ex=redis_instance.session_time)
+            redis_instance.queue_index(pipe, key, redis_instance.session_vm_names(session))
+        await pipe.execute()
+
+async def clean_up(redis_instance, key_prefix):
+    for pattern in (f"{key_prefix}*", f"{redis_instance.index_prefix}bench-*"):
+        keys = [key async for key in redis_instance.client.scan_iter(match=pattern, count=500)]
+        for batch in redis_instance.batches(keys):
+            await redis_instance.client.delete(*batch)
+
+async def bench(redis_instance, args, session_format, vm_count):
+    orphan_count = max(1, vm_count // 10)
+    keys = [f"{args.key_prefix}{i}" for i in range(args.sessions)]
+    orphans, reactivated, renames = sweep_changes(vm_count, orphan_count)
+    timings = []
+    for _ in range(args.rounds):
+        await write_sessions(redis_instance, keys, session_format, vm_count, orphan_count)
+        start_time = time.perf_counter()
+        result = await redis_instance.apply_session_changes(orphans=orphans, reactivated=reactivated, renames=renames)
+        timings.append(time.perf_counter() - start_time)
+        if result["affected_sessions"] != len(keys):
+            raise SystemExit(f"[ERROR] The sweep changed {result['affected_sessions']} of {len(keys)} sessions")
+    await clean_up(redis_instance, args.key_prefix)
+    return statistics.median(timings)
+
+async def run(args):
+    redis_instance = RedisClient({"host": args.host, "port": args.port, "session_time": 600, "batch_size": args.batch_size})
+    # The bench indexes its own sessions - sweeps look them up like with a running session watcher
+    redis_instance.index_ready = True
+    formats = ["json"] + (["msgpack"] if msgpack is not None else [])
+    print(f"{'vms':>6} {'format':>8} {'sessions':>9} {'sweep s':>9} {'us/session':>11}")
+    try:
+        for vm_count in args.vms:
+            for session_format in formats:
+                seconds = await bench(redis_instance, args, session_format, vm_count)
+                print(f"{vm_count:>6} {session_format:>8} {args.sessions:>9} {seconds:>9.3f} {seconds / args.sessions * 1e6:>11.1f}")
+    finally:
+        await clean_up(redis_instance, args.key_prefix)
+        await redis_instance.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Cost of the Lua session sweep (apply_session_changes) per session, for JSON and msgpack sessions")
+    parser.add_argument("--host", default="localhost", help="Redis host (use a scratch instance)")
+    parser.add_argument("--port", type=int, default=6379, help="Redis port")
+    parser.add_argument("--vms", type=int, nargs="+", default=[10, 100, 1000], help="VMs per session")
+    parser.add_argument("--sessions", type=int, default=2000, help="Sessions referencing the changed VMs")
+    parser.add_argument("--rounds", type=int, default=5, help="Sweeps per measurement (the median is reported)")
+    parser.add_argument("--batch-size", type=int, default=500, help="redis.batch_size (sessions per script call)")
+    parser.add_argument("--key-prefix", default="bench_session:", help="Prefix of the bench session keys")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+import collections
+import itertools
+import threading
+import asyncio
+import json
+import time
+import uuid
+
+
+# Event types published for every applied diff
+CHANGE_TYPES = ["added", "updated", "power_changed", "renamed", "orphaned", "reactivated"]
+
+
+class ChangeFeed():
+    def __init__(self, redis_instance, feed_conf=None):
+        """
+        param:
+            redis_instance: The RedisClient the feed is optionally mirrored to (a Redis Stream)
+            feed_conf: Optional change feed configuration (buffer size, stream mirror, keepalive)
+        """
+        self.optional_conf = {
+            "buffer_size": 10000, # Events kept in memory for subscribers to resume from - older offsets get a 'gap' event
+            "redis_stream": False, # Mirror every event to a Redis Stream (XADD) for consumers outside this replica
+            "stream_key": "sync_service:changes", # Key of the Redis Stream
+            "stream_maxlen": 100000, # Approximate max length of the Redis Stream (MAXLEN ~ trimming)
+            "keepalive": 15 # Seconds between SSE keepalive comments on an idle feed
+        }
+        self.load_config(feed_conf or {})
+        self.redis = redis_instance
+        self.lock = threading.Lock()
+        self.events = collections.deque(maxlen=self.buffer_size)
+
+        # Offsets only mean something within one process - event ids ('<boot id>:<offset>') carry the boot id,
+        # so a consumer resuming with an id of an earlier process gets a 'gap' instead of unrelated events
+        self.boot_id = uuid.uuid4().hex[:12]
+        self.next_offset = 1
+        self.waiters = set() # (loop, asyncio.Event) of subscribers waiting for new events
+        self.published = 0
+        self.mirror_errors = 0
+
+    def load_config(self, feed_conf):
+        for conf, default in self.optional_conf.items():
+            setattr(self, conf, feed_conf.get(conf, default))
+
+    def event(self, change_type, host, vm, **data):
+        return {"id": None, "offset": None, "type": change_type, "host": host, "uuid": vm.get("uuid"), "name": vm.get("name"), "time": time.time(), "data": data}
+
+
+    ###################################
+    #             Publish             #
+    ###################################
+
+    async def publish(self, events):
+        # Called by the sync worker once a plan is written - buffer, wake the subscribers, mirror
+        if not events:
+            return
+        with self.lock:
+            for event in events:
+                event["offset"] = self.next_offset
+                event["id"] = self.event_id(self.next_offset)
+                self.next_offset += 1
+                self.events.append(event)
+            self.published += len(events)
+            waiters = list(self.waiters)
+
+        # Subscribers wait on the API server's loop
+        for loop, waiter in waiters:
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(waiter.set)
+
+        if self.redis_stream:
+            await self.mirror(events)
+
+    async def mirror(self, events):
+        # Best effort - the in-memory feed and MongoDB stay authoritative when Redis is down
+        try:
+            async with self.redis.client.pipeline(transaction=False) as pipe:
+                for event in events:
+                    pipe.xadd(self.stream_key, {"offset": event["offset"], "type": event["type"], "event": json.dumps(event, default=str)}, maxlen=self.stream_maxlen, approximate=True)
+                await pipe.execute()
+        except Exception as e:
+            self.mirror_errors += 1
+            print(f"[WARN] Failed to mirror {len(events)} change events to the Redis stream: {e}")
+
+
+    ###################################
+    #            Subscribe            #
+    ###################################
+
+    def event_id(self, offset):
+        return f"{self.boot_id}:{offset}"
+
+    def latest_offset(self):
+        with self.lock:
+            return self.next_offset - 1
+
+    def resume_offset(self, event_id):
+        # Event id to resume after -> (offset, known). An id of another process, or an offset this process never
+        # reached, is unknown: the consumer gets a 'gap' and every event still buffered
+        boot_id, _, offset = str(event_id).rpartition(":")
+        if boot_id == self.boot_id and offset.isdigit() and int(offset) <= self.latest_offset():
+            return int(offset), True
+        with self.lock:
+            oldest = self.events[0]["offset"] if self.events else self.next_offset
+        return oldest - 1, False
+
+    def read(self, offset, limit=None):
+        # Events after offset -> (events, missed); missed counts events after offset already dropped from the buffer
+        with self.lock:
+            oldest = self.events[0]["offset"] if self.events else self.next_offset
+            missed = max(0, oldest - 1 - offset)
+            start = max(0, offset + 1 - oldest)
+            stop = start + limit if limit else None
+            return list(itertools.islice(self.events, start, stop)), missed
+
+    async def wait(self, offset, timeout):
+        # Wait up to timeout seconds for an event after offset, on the caller's loop
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self.lock:
+            if self.next_offset - 1 > offset:
+                return
+            self.waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter[1].wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self.lock:
+                self.waiters.discard(waiter)
+
+    def matches(self, event, hosts=None, types=None):
+        return (not hosts or event["host"] in hosts) and (not types or event["type"] in types)
+
+    def sse_frame(self, event):
+        return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event, default=str)}\n\n"
+
+    def gap_frame(self, after, resume_offset, missed=None):
+        # The id moves the client's Last-Event-ID past the gap; missed=None: the resume id was unknown, how much was missed cannot be told
+        return f"id: {self.event_id(resume_offset)}\nevent: gap\ndata: {json.dumps({'after': after, 'missed': missed, 'boot_id': self.boot_id})}\n\n"
+
+    async def stream(self, offset, hosts=None, types=None, resumed_from=None):
+        # Server-Sent Events from offset on - a 'gap' event for an unknown resume id (resumed_from)
+        # or when the buffer no longer holds every missed event
+        if resumed_from is not None:
+            yield self.gap_frame(resumed_from, offset)
+        while True:
+            events, missed = self.read(offset, limit=500)
+            if missed:
+                yield self.gap_frame(self.event_id(offset), offset + missed, missed)
+                offset += missed
+            for event in events:
+                offset = event["offset"]
+                if self.matches(event, hosts, types):
+                    yield self.sse_frame(event)
+            if not events:
+                await self.wait(offset, self.keepalive)
+                if self.latest_offset() <= offset:
+                    yield ": keepalive\n\n"
+
+
+    ###################################
+    #              Stats              #
+    ###################################
+
+    def stats(self):
+        with self.lock:
+            return {
+                "buffered": len(self.events),
+                "oldest_offset": self.events[0]["offset"] if self.events else None,
+                "latest_offset": self.next_offset - 1,
+                "boot_id": self.boot_id,
+                "published": self.published,
+                "subscribers_waiting": len(self.waiters),
+                "redis_stream": self.stream_key if self.redis_stream else None,
+                "mirror_errors": self.mirror_errors
+            }
@@ -0,0 +1,215 @@
+import asyncio
+import socket
+import random
+import math
+import json
+import time
+import os
+
+
+###################################
+#        Lease Lua Scripts        #
+###################################
+# Renew the leases in KEYS that are still held by this replica -> 1/0 per key
+LUA_RENEW_LEASES = """
+local renewed = {}
+for i, key in ipairs(KEYS) do
+    if redis.call('GET', key) == ARGV[1] then
+        redis.call('PEXPIRE', key, ARGV[2])
+        renewed[i] = 1
+    else
+        renewed[i] = 0
+    end
+end
+return renewed
+"""
+
+# Release the leases in KEYS that are still held by this replica
+LUA_RELEASE_LEASES = """
+local released = 0
+for _, key in ipairs(KEYS) do
+    if redis.call('GET', key) == ARGV[1] then
+        redis.call('DEL', key)
+        released = released + 1
+    end
+end
+return released
+"""
+
+
+class HostCoordinator():
+    def __init__(self, redis_instance, hosts, coordination_conf=None):
+        """
+        param:
+            redis_instance: The RedisClient the leases and the replica membership are kept in
+            hosts: Names of all configured ESXi hosts (every replica loads the same esxi_hosts list)
+            coordination_conf: Optional coordination configuration (replica id, lease timing, key prefix)
+        """
+        self.optional_conf = {
+            "enabled": False, # Shard the ESXi hosts across replicas - off: this replica syncs every host
+            "replica_id": None, # Unique name of this replica (defaults to <hostname>-<pid>)
+            "lease_ttl": 30, # Seconds a host lease (and a replica heartbeat) lives without renewal
+            "renew_interval": 10, # Seconds between lease renewals / rebalancing (keep well below lease_ttl)
+            "key_prefix": "sync_service:" # Prefix of the lease keys, the membership set and the force channel
+        }
+        self.load_config(coordination_conf or {})
+        self.redis = redis_instance
+        self.hosts = sorted(hosts)
+        self.replica_id = self.replica_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.members_key = f"{self.key_prefix}replicas"
+        self.force_channel = f"{self.key_prefix}force"
+        self.owned = set(hosts) if not self.enabled else set()
+        self.members = [self.replica_id]
+        self.loop = None
+
+    def load_config(self, coordination_conf):
+        for conf, default in self.optional_conf.items():
+            setattr(self, conf, coordination_conf.get(conf, default))
+
+    def lease_key(self, host):
+        return f"{self.key_prefix}lease:{host}"
+
+    def owns(self, host):
+        return host in self.owned
+
+
+    ###################################
+    #             Leases              #
+    ###################################
+
+    async def run(self, scheduler):
+        # Heartbeat, renew, rebalance - on the sync worker's loop, next to the scheduler
+        if not self.enabled:
+            return
+        self.loop = asyncio.get_running_loop()
+        client = self.redis.client
+        renew_script = client.register_script(LUA_RENEW_LEASES)
+        release_script = client.register_script(LUA_RELEASE_LEASES)
+        listener = asyncio.create_task(self.listen_force(scheduler))
+        print(f"[INFO] Coordinating {len(self.hosts)} ESXi hosts as replica {self.replica_id}")
+
+        try:
+            while True:
+                try:
+                    await self.rebalance(client, renew_script, release_script, scheduler)
+                except Exception as e:
+                    # Leases are not renewed while Redis is unreachable - stop syncing hosts that may be claimed elsewhere
+                    if self.owned:
+                        print(f"[ERROR] Lease renewal failed, releasing {len(self.owned)} hosts locally: {e}")
+                        self.owned = set()
+                    else:
+                        print(f"[ERROR] Lease renewal failed: {e}")
+                await asyncio.sleep(self.renew_interval)
+        finally:
+            listener.cancel()
+            await self.release_all(release_script)
+
+    async def rebalance(self, client, renew_script, release_script, scheduler):
+        now = time.time()
+        ttl_ms = int(self.lease_ttl * 1000)
+
+        # Membership: heartbeat and drop replicas that missed a whole lease_ttl
+        async with client.pipeline(transaction=False) as pipe:
+            pipe.zadd(self.members_key, {self.replica_id: now})
+            pipe.zremrangebyscore(self.members_key, 0, now - self.lease_ttl)
+            pipe.zrange(self.members_key, 0, -1)
+            _, _, members = await pipe.execute()
+        self.members = sorted(members) or [self.replica_id]
+        fair_share = math.ceil(len(self.hosts) / len(self.members))
+
+        # Renew the leases still held - a lease that expired or was taken over is lost
+        if self.owned:
+            owned = sorted(self.owned)
+            renewed = await renew_script(keys=[self.lease_key(host) for host in owned], args=[self.replica_id, ttl_ms])
+            lost = [host for host, ok in zip(owned, renewed) if not ok]
+            if lost:
+                print(f"[WARN] Lost the leases of {', '.join(lost)}")
+                self.owned.difference_update(lost)
+
+        # Give up hosts above the fair share (a replica joined) - never one that is syncing right now
+        excess = len(self.owned) - fair_share
+        if excess > 0:
+            idle = [host for host in sorted(self.owned) if not scheduler.is_host_running(host)]
+            released = idle[:excess]
+            if released:
+                await release_script(keys=[self.lease_key(host) for host in released], args=[self.replica_id])
+                self.owned.difference_update(released)
+                print(f"[INFO] Released {', '.join(released)} for rebalancing ({len(self.members)} replicas)")
+
+        # Claim free hosts up to the fair share (a replica died or this one just joined)
+        free = [host for host in self.hosts if host not in self.owned]
+        random.shuffle(free)
+        # Never more than wanted at a time, so a replica starting first does not grab the hosts of the others
+        wanted = fair_share - len(self.owned)
+        gained = []
+        while len(gained) < wanted and free:
+            candidates, free = free[:wanted - len(gained)], free[wanted - len(gained):]
+            async with client.pipeline(transaction=False) as pipe:
+                for host in candidates:
+                    pipe.set(self.lease_key(host), self.replica_id, nx=True, px=ttl_ms)
+                claimed = await pipe.execute()
+            gained += [host for host, ok in zip(candidates, claimed) if ok]
+        for host in gained:
+            self.owned.add(host)
+            scheduler.host_gained(host)
+        if gained:
+            print(f"[INFO] Claimed {', '.join(gained)} ({len(self.owned)}/{len(self.hosts)} hosts, {len(self.members)} replicas)")
+
+    async def release_all(self, release_script):
+        if not self.owned:
+            return
+        try:
+            await release_script(keys=[self.lease_key(host) for host in self.owned], args=[self.replica_id])
+            await self.redis.client.zrem(self.members_key, self.replica_id)
+        except Exception as e:
+            print(f"[WARN] Failed to release the host leases: {e}")
+        self.owned = set()
+
+
+    ###################################
+    #           Forced Sync           #
+    ###################################
+
+    def request_force(self, hosts=None):
+        # Thread-safe: /sync/now is published to every replica, each forces the hosts it owns
+        if not self.enabled or self.loop is None:
+            return False
+        asyncio.run_coroutine_threadsafe(self.publish_force(hosts), self.loop)
+        return True
+
+    async def publish_force(self, hosts=None):
+        await self.redis.client.publish(self.force_channel, json.dumps({"hosts": hosts, "from": self.replica_id}))
+
+    async def listen_force(self, scheduler):
+        while True:
+            pubsub = self.redis.client.pubsub()
+            try:
+                await pubsub.subscribe(self.force_channel)
+                async for message in pubsub.listen():
+                    if message.get("type") != "message":
+                        continue
+                    hosts = json.loads(message.get("data") or "{}").get("hosts")
+                    owned = [host for host in (hosts or self.hosts) if self.owns(host)]
+                    if owned:
+                        scheduler.force(owned)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[WARN] Force sync listener failed, resubscribing: {e}")
+                await asyncio.sleep(self.renew_interval)
+            finally:
+                await pubsub.aclose()
+
+
+    ###################################
+    #              Stats              #
+    ###################################
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "replica_id": self.replica_id,
+            "replicas": self.members,
+            "owned_hosts": sorted(self.owned),
+            "total_hosts": len(self.hosts)
+        }
@@ -0,0 +1,159 @@
+from pyVim.connect import Disconnect
+from pyVmomi import vim
+from contextlib import contextmanager
+import threading
+import time
+
+
+class EsxiSession():
+    def __init__(self, service_instance):
+        self.service_instance = service_instance
+        self.content = service_instance.RetrieveContent()
+        self.last_used = time.monotonic()
+
+
+class EsxiSessionPool():
+    def __init__(self, host, connect, max_sessions=2, validate_after=30, acquire_timeout=60):
+        """
+        param:
+            host: ESXi host address (used for logging only)
+            connect: A callable that logs into the host and returns a service instance or None
+            max_sessions: Max concurrent authenticated sessions kept against the host
+            validate_after: Idle seconds after which a session is validated before reuse
+            acquire_timeout: Seconds to wait for a free session slot
+        """
+        self.host = host
+        self.connect = connect
+        self.max_sessions = max_sessions
+        self.validate_after = validate_after
+        self.acquire_timeout = acquire_timeout
+        self.slots = threading.BoundedSemaphore(max_sessions)
+        self.lock = threading.Lock()
+        self.idle = []
+        self.in_use = 0
+        self.logins = 0
+        self.login_failures = 0
+        self.reconnects = 0
+        self.last_connect_latency = None
+        self.total_connect_latency = 0.0
+
+
+    ###################################
+    #            Sessions             #
+    ###################################
+
+    def login(self):
+        start_time = time.monotonic()
+        service_instance = self.connect()
+        latency = time.monotonic() - start_time
+
+        with self.lock:
+            if not service_instance:
+                self.login_failures += 1
+                raise ConnectionError(f"Cannot log into ESXi host {self.host}")
+            self.logins += 1
+            self.last_connect_latency = latency
+            self.total_connect_latency += latency
+
+        return EsxiSession(service_instance)
+
+    def is_alive(self, session):
+        if time.monotonic() - session.last_used < self.validate_after:
+            return True
+        try:
+            return session.content.sessionManager.currentSession is not None
+        except Exception:
+            return False
+
+    def acquire(self):
+        if not self.slots.acquire(timeout=self.acquire_timeout):
+            raise TimeoutError(f"No free ESXi session for {self.host} after {self.acquire_timeout}s (max_sessions={self.max_sessions})")
+
+        try:
+            while True:
+                with self.lock:
+                    session = self.idle.pop() if self.idle else None
+                if session is None:
+                    session = self.login()
+                    break
+                if self.is_alive(session):
+                    break
+                with self.lock:
+                    self.reconnects += 1
+                self.close_session(session)
+        except Exception:
+            self.slots.release()
+            raise
+
+        with self.lock:
+            self.in_use += 1
+        return session
+
+    def release(self, session):
+        session.last_used = time.monotonic()
+        with self.lock:
+            self.in_use -= 1
+            self.idle.append(session)
+        self.slots.release()
+
+    def discard(self, session):
+        with self.lock:
+            self.in_use -= 1
+            self.reconnects += 1
+        self.close_session(session)
+        self.slots.release()
+
+    def close_session(self, session):
+        try:
+            Disconnect(session.service_instance)
+        except Exception:
+            pass
+
+    @contextmanager
+    def session(self):
+        session = self.acquire()
+        try:
+            yield session
+        except vim.fault.NotAuthenticated:
+            self.discard(session)
+            raise
+        except BaseException:
+            self.release(session)
+            raise
+        else:
+            self.release(session)
+
+    def call(self, func):
+        # Run func(session) and retry once on a fresh login if the session was dropped by the host
+        try:
+            with self.session() as session:
+                return func(session)
+        except vim.fault.NotAuthenticated:
+            print(f"[WARN] ESXi session for {self.host} is no longer authenticated, reconnecting...")
+            with self.session() as session:
+                return func(session)
+
+    def close(self):
+        with self.lock:
+            sessions, self.idle = self.idle, []
+        for session in sessions:
+            self.close_session(session)
+
+
+    ###################################
+    #              Stats              #
+    ###################################
+
+    def stats(self):
+        with self.lock:
+            return {
+                "host": self.host,
+                "max_sessions": self.max_sessions,
+                "in_use": self.in_use,
+                "idle": len(self.idle),
+                "logins": self.logins,
+                "login_failures": self.login_failures,
+                "reconnects": self.reconnects,
+                "last_connect_latency": round(self.last_connect_latency, 3) if self.last_connect_latency is not None else None,
+                "avg_connect_latency": round(self.total_connect_latency / self.logins, 3) if self.logins else None
+            }
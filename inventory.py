@@ -0,0 +1,100 @@
+import time
+
+
+class VmRecord():
+    # One VM of a host snapshot - slots keep large inventories compact
+    __slots__ = ("uuid", "name", "hostname", "addr", "power_state", "vmware_tools")
+
+    def __init__(self, vm):
+        for field in self.__slots__:
+            setattr(self, field, vm.get(field))
+
+    def values(self):
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+    def to_dict(self, host):
+        return {"esxi_host_addr": host, **{field: getattr(self, field) for field in self.__slots__}}
+
+
+class InventorySnapshot():
+    def __init__(self, host, records=None, generation=0, changed_at=None, complete=False):
+        """
+        param:
+            host: ESXi host the inventory was collected from
+            records: VM uuid -> VmRecord
+            generation: Incremented by every collection (0 = never collected)
+            changed_at: Epoch time of the collection that produced this version (kept by unchanged collections)
+            complete: Built on a full collection - partial updates before the first one are ignored
+        """
+        # The records of a snapshot are never modified - a changed collection builds a new one, so readers need no lock
+        self.host = host
+        self.records = records or {}
+        self.generation = generation
+        self.changed_at = changed_at
+        self.complete = complete
+
+        # Indexes: name -> uuids (names are not unique), power state -> records, records ordered by name
+        self.ordered = sorted(self.records.values(), key=lambda record: (record.name or "", record.uuid))
+        self.by_name = {}
+        self.by_power_state = {}
+        for record in self.ordered:
+            self.by_name.setdefault(record.name, []).append(record.uuid)
+            self.by_power_state.setdefault(record.power_state, []).append(record)
+
+
+    ###################################
+    #             Updates             #
+    ###################################
+
+    def replaced(self, vms):
+        # Full collection -> new snapshot holding exactly these VMs (the same snapshot if nothing changed)
+        records = {vm["uuid"]: VmRecord(vm) for vm in vms if vm.get("uuid")}
+        # Nothing in a snapshot changes once built, not even a timestamp - an unchanged one may be serving a response under its ETag
+        if self.complete and records.keys() == self.records.keys() and all(record.values() == self.records[uuid].values() for uuid, record in records.items()):
+            return self
+        return InventorySnapshot(self.host, records, self.generation + 1, time.time(), complete=True)
+
+    def updated(self, changed_vms, removed_uuids=()):
+        # Partial collection (incremental updates, selected VMs) -> new snapshot (the same snapshot if nothing changed)
+        if not self.complete:
+            # A handful of selected VMs is not the host's inventory - wait for the first full collection
+            return self
+        records = dict(self.records)
+        changed = False
+        for vm in changed_vms:
+            if vm.get("uuid"):
+                record = VmRecord(vm)
+                previous = records.get(record.uuid)
+                changed = changed or previous is None or previous.values() != record.values()
+                records[record.uuid] = record
+        for uuid in removed_uuids:
+            changed = records.pop(uuid, None) is not None or changed
+        if not changed:
+            return self
+        return InventorySnapshot(self.host, records, self.generation + 1, time.time(), complete=True)
+
+
+    ###################################
+    #              Reads              #
+    ###################################
+
+    def get(self, uuid):
+        return self.records.get(uuid)
+
+    def select(self, name=None, power_state=None):
+        # Records matching the filters, ordered by name
+        if name is not None:
+            records = [self.records[uuid] for uuid in self.by_name.get(name, [])]
+            return [record for record in records if power_state is None or record.power_state == power_state]
+        if power_state is not None:
+            return self.by_power_state.get(power_state, [])
+        return self.ordered
+
+    def stats(self):
+        return {
+            "host": self.host,
+            "vms": len(self.records),
+            "generation": self.generation,
+            "complete": self.complete,
+            "changed_at": self.changed_at
+        }
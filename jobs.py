@@ -0,0 +1,148 @@
+import asyncio
+import time
+import uuid
+
+
+# 'partial': some hosts belong to other replicas and were only forced there; 'skipped': every host was
+FINISHED_STATUSES = {"succeeded", "partial", "skipped", "failed"}
+
+
+class SyncJobs():
+    def __init__(self, sync_instances, coordinator, jobs_conf=None):
+        """
+        param:
+            sync_instances: The Sync instances selected VMs are synced from (one per ESXi host)
+            coordinator: The HostCoordinator - jobs only run against the hosts this replica owns
+            jobs_conf: Optional job configuration (coalescing window, retention)
+        """
+        self.optional_conf = {
+            "coalesce_window": 0.5, # Seconds a new job waits for others to join its ESXi pass
+            "retention": 3600, # Seconds finished jobs stay queryable
+            "max_jobs": 1000 # Max jobs kept - the oldest finished jobs are dropped first
+        }
+        self.load_config(jobs_conf or {})
+        self.sync_instances = sync_instances
+        self.coordinator = coordinator
+        self.jobs = {}
+        self.batch = None # Batch still collecting jobs, run once coalesce_window is over
+        self.tasks = set()
+
+    def load_config(self, jobs_conf):
+        for conf, default in self.optional_conf.items():
+            setattr(self, conf, jobs_conf.get(conf, default))
+
+
+    ###################################
+    #              Jobs               #
+    ###################################
+
+    def submit(self, vm_ids):
+        # Queue a job -> the job; jobs submitted within coalesce_window share one ESXi pass per host
+        self.prune()
+        job = {
+            "id": uuid.uuid4().hex,
+            "status": "queued",
+            "vms": list(vm_ids),
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "coalesced_jobs": 1,
+            "result": None,
+            "error": None
+        }
+        self.jobs[job["id"]] = job
+
+        if self.batch is None:
+            self.batch = {"jobs": [], "done": asyncio.Event()}
+            task = asyncio.create_task(self.run_batch(self.batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        self.batch["jobs"].append(job)
+        job["done"] = self.batch["done"]
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    async def wait(self, job, timeout):
+        # Wait up to timeout seconds for the job to finish -> the job as it is then
+        if timeout and job["status"] in {"queued", "running"}:
+            try:
+                await asyncio.wait_for(asyncio.shield(job["done"].wait()), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+        return job
+
+    def view(self, job):
+        return {key: value for key, value in job.items() if key != "done"}
+
+    def prune(self):
+        now = time.time()
+        finished = [job for job in self.jobs.values() if job["finished_at"] is not None]
+        expired = [job["id"] for job in finished if now - job["finished_at"] > self.retention]
+        overflow = len(self.jobs) - len(expired) - self.max_jobs + 1
+        if overflow > 0:
+            live = sorted((job for job in finished if job["id"] not in expired), key=lambda job: job["finished_at"])
+            expired += [job["id"] for job in live[:overflow]]
+        for job_id in expired:
+            self.jobs.pop(job_id, None)
+
+
+    ###################################
+    #             Batches             #
+    ###################################
+
+    async def run_batch(self, batch):
+        await asyncio.sleep(self.coalesce_window)
+        self.batch = None
+
+        jobs = batch["jobs"]
+        vm_ids = set()
+        for job in jobs:
+            vm_ids.update(job["vms"])
+            job["status"] = "running"
+            job["started_at"] = time.time()
+            job["coalesced_jobs"] = len(jobs)
+
+        hosts = [sync for sync in self.sync_instances if self.coordinator.owns(sync.host)]
+        # Hosts of other replicas: their owners get a forced sync, the job does not report them as synced
+        skipped = [sync.host for sync in self.sync_instances if not self.coordinator.owns(sync.host)]
+        forwarded = bool(skipped) and self.coordinator.request_force(skipped)
+        print(f"[SYNC JOBS] {len(jobs)} jobs coalesced into one pass over {len(hosts)} hosts for {len(vm_ids)} VMs ({len(skipped)} hosts skipped)")
+        results = await asyncio.gather(*(sync.sync_selected_vms(vm_ids) for sync in hosts), return_exceptions=True)
+
+        for job in jobs:
+            job["result"] = [self.job_result(job, sync.host, result) for sync, result in zip(hosts, results)]
+            job["result"] += [self.skipped_result(host, forwarded) for host in skipped]
+            job["status"] = self.job_status(job["result"])
+            job["finished_at"] = time.time()
+        batch["done"].set()
+
+    def job_status(self, host_results):
+        if any(not host_result["ok"] and not host_result.get("skipped") for host_result in host_results):
+            return "failed"
+        if all(host_result.get("skipped") for host_result in host_results):
+            return "skipped"
+        return "partial" if any(host_result.get("skipped") for host_result in host_results) else "succeeded"
+
+    def skipped_result(self, host, forwarded):
+        # A host leased by another replica - forwarded: that replica was asked for a forced (full) sync of it
+        return {"host": host, "ok": False, "skipped": True, "forwarded": forwarded, "error": "host is synced by another replica"}
+
+    def job_result(self, job, host, result):
+        # The part of a host's pass that the job asked for
+        if isinstance(result, Exception):
+            return {"host": host, "ok": False, "error": str(result)}
+
+        requested = set(job["vms"])
+        vms = [vm for vm in result.get("vms", []) if vm["uuid"] in requested or vm["name"] in requested]
+        return {
+            "host": host,
+            "ok": result.get("ok", False),
+            "matched": len(vms),
+            "added": sum(1 for vm in vms if vm["status"] == "added"),
+            "updated": sum(1 for vm in vms if vm["status"] == "updated"),
+            "unchanged": sum(1 for vm in vms if vm["status"] == "unchanged"),
+            "failed": result.get("failed", 0),
+            "vms": vms
+        }
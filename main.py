@@ -1,10 +1,17 @@
 from sync import Sync
 from mongodb import Mongodb
 from server import APIServer
+from redis_client import RedisClient
+from rename_notifier import RenameNotifier
+from outbox import Outbox, OutboxDispatcher
+from scheduler import HostScheduler
+from coordinator import HostCoordinator
+from jobs import SyncJobs
+from changefeed import ChangeFeed
 import yaml
 import threading
 import os
-import concurrent.futures
+import sys
 import time
 import asyncio
 
@@ -13,8 +20,8 @@ import asyncio
 #          GLOBAL VARS        #
 ###############################
 CONFIG_FILE = os.getenv("CONFIG_FILE", "sync.yaml") # Get the config file from env var name 'CONFIG_FILE' default config file path is'./sync.yaml'
-SYNC_IN_PROCESS = False # Flag for sync in process, while sync in process this flag will be 'True' 
-FORCE_SYNC_EVENT = threading.Event() # Signal for event triggering
+SYNC_IN_PROCESS = False # Flag for sync in process, while any host is syncing this flag will be 'True'
+WORKERS = [] # (event loop, main task) of every background worker - cancelled on shutdown
 
 ###############################
 #          LOAD CONF          #
@@ -28,92 +35,254 @@ def load_config():
 #      Create Instances       #
 ###############################
 # Create esxi instance which can be later will used for syncing -> return a list of esxi instances
-def create_esxi_instances(esxi_conf, mongodb_instance, redis_conf, endpoints):
+def create_esxi_instances(esxi_conf, mongodb_instance, redis_instance, outbox, changefeed):
     sync_instances = []
 
     for esxi_host in range(len(esxi_conf)):
         sync_instances.append(
-            Sync(esxi_conf[esxi_host], mongodb_instance, redis_conf, endpoints)
+            Sync(esxi_conf[esxi_host], mongodb_instance, redis_instance, outbox, changefeed)
         )
 
     return sync_instances
 
-# Create a mongodb instance
+# Create a mongodb instance, provision its indexes and check the hot query plans
 def create_mongodb_instance(mongodb_conf):
-    return Mongodb(mongodb_conf)
+    mongodb_instance = Mongodb(mongodb_conf)
+    if mongodb_instance.ensure_indexes:
+        mongodb_instance.create_indexes()
+    mongodb_instance.check_query_plans()
+    return mongodb_instance
+
+# Create the redis instance shared by every sync instance and the API server
+def create_redis_instance(redis_conf):
+    redis_instance = RedisClient(redis_conf)
+    print(f"[INIT] Redis pool: up to {redis_instance.max_connections} connections per event loop to {redis_instance.unix_socket_path or f'{redis_instance.host}:{redis_instance.port}'}")
+    return redis_instance
+
+# Create the rename notifier used by the outbox dispatcher (one keep-alive HTTP client, bounded concurrency)
+def create_notifier_instance(endpoints, notifier_conf):
+    return RenameNotifier(endpoints, notifier_conf)
+
+# Create the outbox the sync instances queue session changes and rename notifications in
+def create_outbox_instance(mongodb_instance, outbox_conf):
+    outbox_instance = Outbox(mongodb_instance, outbox_conf)
+    if mongodb_instance.ensure_indexes:
+        outbox_instance.create_indexes()
+    return outbox_instance
+
+# Create the change feed the sync instances publish every applied diff to (served as SSE by the API server)
+def create_changefeed_instance(redis_instance, changefeed_conf):
+    changefeed = ChangeFeed(redis_instance, changefeed_conf)
+    if changefeed.redis_stream and redis_instance.is_session_key(changefeed.stream_key):
+        print(f"[WARN] The change stream {changefeed.stream_key} is not under redis.internal_prefixes - session scans skip it only by type")
+    if changefeed.redis_stream:
+        print(f"[INIT] Mirroring change events to the Redis stream {changefeed.stream_key} (maxlen ~{changefeed.stream_maxlen})")
+    return changefeed
+
+# Create the coordinator that shards the ESXi hosts across replicas through Redis leases
+def create_coordinator_instance(redis_instance, sync_instances, coordination_conf):
+    coordinator = HostCoordinator(redis_instance, [instance.host for instance in sync_instances], coordination_conf)
+    if coordinator.enabled and redis_instance.is_session_key(coordinator.lease_key("")):
+        print(f"[WARN] coordination.key_prefix {coordinator.key_prefix} is not under redis.internal_prefixes - session scans would read the host leases")
+    for instance in sync_instances:
+        instance.coordinator = coordinator
+    if coordinator.enabled:
+        print(f"[INIT] Host sharding enabled as replica {coordinator.replica_id} (lease ttl {coordinator.lease_ttl}s)")
+    return coordinator
+
+# Create the per-host scheduler (own interval, jitter, backoff and circuit breaker per host)
+def create_scheduler_instance(sync_instances, sync_conf, coordinator):
+    return HostScheduler(sync_instances, sync_conf, coordinator)
 
 # Create API server instance
-def create_api_instance(api_conf, sync_instances):
+def create_api_instance(api_conf, sync_instances, redis_instance, notifier, outbox, scheduler, coordinator, jobs_conf, changefeed):
     return APIServer(
         api_conf,
         sync_status_getter=lambda: SYNC_IN_PROCESS,
-        force_sync_trigger=lambda: FORCE_SYNC_EVENT.set(),
-        sync_instances=sync_instances
+        # Sharded: published to every replica, each forces the hosts it owns
+        force_sync_trigger=lambda hosts=None: coordinator.request_force(hosts) or scheduler.force(hosts),
+        sync_instances=sync_instances,
+        redis_instance=redis_instance,
+        notifier=notifier,
+        outbox=outbox,
+        scheduler=scheduler,
+        coordinator=coordinator,
+        jobs=SyncJobs(sync_instances, coordinator, jobs_conf),
+        changefeed=changefeed
     )
 
 ###############################
 #          Sync Runner        #
 ###############################
-def perform_sync(sync_instances):
-    for instance in sync_instances:
-        print(f"[INFO] Syncing with ESXi host: {instance.host}")
-        try:
-            result = asyncio.run(instance.sync_vms())
-            print(f"[SYNC RESULT] {instance.host} → {result}")
-        except Exception as e:
-            print(f"[ERROR] Failed to sync with {instance.host}: {e}")
-
-def run(sync_instances, interval, timeout):
+async def sync_host(instance, host_timeout):
+    print(f"[INFO] Syncing with ESXi host: {instance.host}")
+    start_time = time.time()
+    try:
+        # wait_for cancels the host's sync task when the timeout fires
+        result = await asyncio.wait_for(instance.sync_cycle(), timeout=host_timeout)
+        print(f"[SYNC RESULT] {instance.host} → {result}")
+    except asyncio.TimeoutError:
+        instance.abandon_inflight()
+        result = {"ok": False, "error": f"Sync exceeded {host_timeout} seconds", "timed_out": True}
+        print(f"[TIMEOUT] Sync with {instance.host} exceeded {host_timeout} seconds. Operation canceled.")
+    except Exception as e:
+        result = {"ok": False, "error": str(e)}
+        print(f"[ERROR] Failed to sync with {instance.host}: {e}")
+
+    return {"host": instance.host, "elapsed": round(time.time() - start_time, 2), "result": result}
+
+async def perform_host_sync(instance, semaphore, host_timeout, scheduler, dispatcher):
+    async with semaphore:
+        host_result = await sync_host(instance, host_timeout)
+
+    scheduler.finished(instance.host, host_result["result"], host_result["elapsed"])
+
+    # Deliver the queued notifications once the last running host is done instead of at the next poll - one
+    # session sweep for the whole cycle, not one per host
+    if not scheduler.is_running():
+        dispatcher.wake()
+
+    status = "ok" if host_result["result"].get("ok") else "failed"
+    print(f"[SYNC SUMMARY] {instance.host}: {status} in {host_result['elapsed']}s")
+    return host_result
+
+async def run(scheduler, timeout, max_parallel, dispatcher, coordinator):
+    # Every host runs as its own task on this loop - a slow or unreachable host only holds its own task
     global SYNC_IN_PROCESS
-    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
-    
-    while True:
-        # Wait for the interval or force sync trigger
-        FORCE_SYNC_EVENT.wait(timeout=interval)
-        print(f"[INFO] Starting sync... (triggered manually or interval={interval}s)")
-        
-        SYNC_IN_PROCESS = True
-        start_time = time.time()
-        print("🔁 Syncing...")
-        try:
-            future = executor.submit(perform_sync, sync_instances)
-            future.result(timeout=timeout)
-        except concurrent.futures.TimeoutError:
-            print(f"[TIMEOUT] Sync exceeded {timeout} seconds. Operation canceled.")
-        except Exception as e:
-            print(f"[ERROR] Unexpected error during sync: {e}")
-        finally:
-            SYNC_IN_PROCESS = False
-            FORCE_SYNC_EVENT.clear()
-            elapsed = round(time.time() - start_time, 2)
-            print(f"[INFO] Sync completed or aborted. Duration: {elapsed}s\n")
+    semaphore = asyncio.Semaphore(max_parallel)
+    tasks = set()
+    coordinator_task = asyncio.create_task(coordinator.run(scheduler)) # Referenced so the lease task is not garbage collected
+
+    try:
+        while True:
+            await scheduler.wait()
+
+            for instance in scheduler.take_due():
+                print(f"[INFO] Starting sync of {instance.host}")
+                task = asyncio.create_task(perform_host_sync(instance, semaphore, timeout, scheduler, dispatcher))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+            SYNC_IN_PROCESS = scheduler.is_running()
+    finally:
+        # Shutdown: let the coordinator release its leases and the host runs stop before the Redis pool is closed
+        coordinator_task.cancel()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(coordinator_task, *tasks, return_exceptions=True)
+
+# The sync worker: one event loop for the lifetime of the service
+def run_sync_worker(scheduler, timeout, max_parallel, dispatcher, coordinator, redis_instance):
+    try:
+        asyncio.run(run_worker(run(scheduler, timeout, max_parallel, dispatcher, coordinator), redis_instance.close))
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        print(f"[FATAL] Sync worker stopped: {e}")
+
+
+###############################
+#           Shutdown          #
+###############################
+# Run a worker's main coroutine - cancelled by stop_workers, then the clients bound to its loop are closed
+async def run_worker(coroutine, *closers):
+    WORKERS.append((asyncio.get_running_loop(), asyncio.current_task()))
+    try:
+        return await coroutine
+    finally:
+        for close in closers:
+            try:
+                await close()
+            except Exception as e:
+                print(f"[WARN] Failed to close a client on shutdown: {e}")
+
+def stop_workers(threads, timeout=10):
+    for loop, task in WORKERS:
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(task.cancel)
+    for thread in threads:
+        thread.join(timeout)
+
+
+###############################
+#            Outbox           #
+###############################
+# Drain the outbox (Redis session sweep + rename notifications) on its own event loop, off the sync path
+def run_outbox_dispatcher(dispatcher, redis_instance, notifier):
+    try:
+        asyncio.run(run_worker(dispatcher.run(), notifier.close, redis_instance.close))
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        print(f"[ERROR] Outbox dispatcher stopped: {e}")
+
+
+###############################
+#        Session Index        #
+###############################
+# Rebuild the VM name -> session keys index from scratch (run as: python main.py rebuild-session-index)
+def rebuild_session_index(redis_conf):
+    redis_instance = RedisClient(redis_conf)
+    result = asyncio.run(run_worker(redis_instance.rebuild_session_index(), redis_instance.close))
+    print(f"[INFO] Session index rebuilt: {result['indexed_vms']} VMs indexed, {result['removed_vms']} stale VMs removed.")
+
+# Keep the session index current for sessions written by other services
+def watch_session_index(redis_instance):
+    try:
+        asyncio.run(run_worker(redis_instance.watch_session_writes(), redis_instance.close))
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        print(f"[ERROR] Session index watcher stopped: {e}")
 
 
 def main():
     try:
         config = load_config()
         mongodb_instance = create_mongodb_instance(config['mongodb'])
-        sync_instances = create_esxi_instances(config['esxi_hosts'], mongodb_instance, config["redis"] ,config["endpoints"])
-        api_instance = create_api_instance(config['api_server'], sync_instances)
+        redis_instance = create_redis_instance(config["redis"])
+        notifier = create_notifier_instance(config["endpoints"], config.get("notifier", {}))
+        outbox = create_outbox_instance(mongodb_instance, config.get("outbox", {}))
+        dispatcher = OutboxDispatcher(outbox, redis_instance, notifier)
+        changefeed = create_changefeed_instance(redis_instance, config.get("changefeed", {}))
+        sync_instances = create_esxi_instances(config['esxi_hosts'], mongodb_instance, redis_instance, outbox, changefeed)
+        coordinator = create_coordinator_instance(redis_instance, sync_instances, config.get("coordination", {}))
+        scheduler = create_scheduler_instance(sync_instances, config['sync'], coordinator)
+        api_instance = create_api_instance(config['api_server'], sync_instances, redis_instance, notifier, outbox, scheduler, coordinator, config.get("jobs", {}), changefeed)
         interval = config['sync']['interval']
         timeout = config['sync']['timeout']
+        max_parallel = config['sync'].get('max_parallel', 4)
 
         print(f"[INIT] Loaded {len(sync_instances)} ESXi hosts for sync.")
-        print(f"[INIT] Sync interval set to {interval} seconds.")
+        print(f"[INIT] Default sync interval set to {interval} seconds.")
+        print(f"[INIT] Syncing up to {max_parallel} hosts in parallel.")
 
 
         # Start the run function in a separate thread
         sync_thread = threading.Thread(
-            target=run,
-            args=(sync_instances, interval, timeout),
+            target=run_sync_worker,
+            args=(scheduler, timeout, max_parallel, dispatcher, coordinator, redis_instance),
             daemon=True  # Automatically stops when main thread exits
         )
+        threads = [sync_thread, threading.Thread(target=run_outbox_dispatcher, args=(dispatcher, redis_instance, notifier), daemon=True)]
+
+        # Rebuilds the session index at startup, then keeps it current - sweeps SCAN until it is ready
+        if redis_instance.session_index_watcher:
+            threads.append(threading.Thread(target=watch_session_index, args=(redis_instance,), daemon=True))
+
+        for thread in threads:
+            thread.start()
 
-        sync_thread.start()
+        # Returns once uvicorn shut down (SIGINT/SIGTERM) - stop the workers so their HTTP clients and pools get closed
         api_instance.run()
+        print("[INFO] Shutting down the sync workers...")
+        stop_workers(threads)
     except Exception as e:
         print(f"[FATAL] Failed to start sync service: {e}")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == "rebuild-session-index":
+        rebuild_session_index(load_config()["redis"])
+    else:
+        main()
\ No newline at end of file
@@ -1,14 +1,43 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne, ASCENDING
+from pymongo.errors import BulkWriteError, PyMongoError
 import urllib.parse
+import concurrent.futures
+import functools
+import asyncio
 
 class Mongodb():
     def __init__(self, mongodb_conf):
         self.required_conf = ["host", "port", "username", "password", "db", "collection"]
+        self.optional_conf = {
+            "bulk_batch_size": 1000, # Max operations sent in a single bulk_write
+            "max_pool_size": 10, # Max MongoDB connections (and executor workers running blocking pymongo calls)
+            "min_pool_size": 0, # Connections kept open while idle
+            "connect_timeout_ms": 5000, # Timeout for establishing a connection
+            "server_selection_timeout_ms": 5000, # Timeout for finding an available server
+            "socket_timeout_ms": 30000, # Timeout for a single query/write on an open connection
+            "wait_queue_timeout_ms": 10000, # Timeout for waiting on a free connection from the pool
+            "ensure_indexes": True, # Create the VM collection indexes on startup
+            "cursor_batch_size": 1000 # Documents fetched per cursor batch when streaming a host's VMs
+        }
         self.load_config(mongodb_conf)
         self.client = None
+        self.executor = None
         self.db_ref = None
         self.collection_ref = None
         self.required_fields = ["esxi_host_addr", "name", "hostname", "addr", "uuid", "power_state", "vmware_tools", "orphan", "orphan_since", "last_sync_time"]
+        # Indexes backing the hot queries (name -> keys, options)
+        self.indexes = {
+            "esxi_host_addr_uuid": ([("esxi_host_addr", ASCENDING), ("uuid", ASCENDING)], {"unique": True}),
+            "uuid": ([("uuid", ASCENDING)], {}),
+            "name": ([("name", ASCENDING)], {})
+        }
+        # Hot query filters checked by check_query_plans
+        self.hot_queries = {
+            "get_vm_index_per_host": {"esxi_host_addr": "__explain__"},
+            "get_vms_by_uuid": {"esxi_host_addr": "__explain__", "uuid": {"$in": ["__explain__"]}},
+            "get_by_uuid": {"uuid": "__explain__"},
+            "get_by_name": {"name": "__explain__"}
+        }
         self.connect()
 
     def load_config(self, mongodb_conf):
@@ -17,19 +46,82 @@ class Mongodb():
                 raise ValueError(f"Missing required configurations in mongodb: mongodb.{conf}")
             setattr(self, conf, mongodb_conf.get(conf))            
 
-        
+        for conf, default in self.optional_conf.items():
+            setattr(self, conf, mongodb_conf.get(conf, default))
 
     def connect(self):
         encoded_username = urllib.parse.quote_plus(self.username)
         encoded_password = urllib.parse.quote_plus(self.password)
         connection_string = f"mongodb://{encoded_username}:{encoded_password}@{self.host}:{self.port}"
-        self.client = MongoClient(connection_string) # Connect into mongodb
+        self.client = MongoClient(
+            connection_string,
+            maxPoolSize=self.max_pool_size,
+            minPoolSize=self.min_pool_size,
+            connectTimeoutMS=self.connect_timeout_ms,
+            serverSelectionTimeoutMS=self.server_selection_timeout_ms,
+            socketTimeoutMS=self.socket_timeout_ms,
+            waitQueueTimeoutMS=self.wait_queue_timeout_ms
+        ) # Connect into mongodb
+        # pymongo is blocking - every query runs on this executor so it never stalls the awaiting event loop
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_pool_size,
+            thread_name_prefix="mongodb"
+        )
         self.db_ref = self.client[self.db] # Use the desired db
         self.collection_ref = self.db_ref[self.collection] # Use the desired collection
     
     def disconnect(self):
         if self.client is not None:
             self.client.close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+    async def run_blocking(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+
+    ##############################
+    #           Indexes          #
+    ##############################
+
+    def create_indexes(self):
+        # create_index is a no-op when an identical index already exists, so this is safe on every startup
+        for index_name, (keys, options) in self.indexes.items():
+            try:
+                self.collection_ref.create_index(keys, name=index_name, **options)
+                print(f"[INIT] MongoDB index ensured: {self.collection}.{index_name}")
+            except PyMongoError as e:
+                print(f"[WARN] Failed to ensure MongoDB index {self.collection}.{index_name}: {e}")
+
+    def plan_stages(self, plan):
+        # Collect every 'stage' of an explain() plan tree
+        stages = []
+        if isinstance(plan, dict):
+            if "stage" in plan:
+                stages.append(plan["stage"])
+            for value in plan.values():
+                stages.extend(self.plan_stages(value))
+        elif isinstance(plan, list):
+            for value in plan:
+                stages.extend(self.plan_stages(value))
+        return stages
+
+    def check_query_plans(self):
+        # Run explain() on every hot query and warn when one of them falls back to a collection scan
+        results = {}
+        for query_name, query_filter in self.hot_queries.items():
+            try:
+                explain = self.collection_ref.find(query_filter).explain()
+            except PyMongoError as e:
+                print(f"[WARN] Failed to explain MongoDB query {query_name}: {e}")
+                continue
+
+            stages = self.plan_stages(explain.get("queryPlanner", {}).get("winningPlan", {}))
+            results[query_name] = {"stages": stages, "collscan": "COLLSCAN" in stages}
+            if "COLLSCAN" in stages:
+                print(f"[WARN] MongoDB query {query_name} {query_filter} uses a COLLSCAN - an index is missing on {self.collection}")
+        return results
 
 
     ##############################
@@ -60,14 +152,15 @@ class Mongodb():
             return False
 
         # Insert if not exists
-        return self.collection_ref.insert_one(data).acknowledged
+        result = await self.run_blocking(self.collection_ref.insert_one, data)
+        return result.acknowledged
 
     
     async def get(self, uuid=None, name=None):
         if not uuid and not name:
             return None
         query_filter = {"name": name} if name else {"uuid": uuid}
-        return self.collection_ref.find_one(query_filter)
+        return await self.run_blocking(self.collection_ref.find_one, query_filter)
 
     async def update(self, data):
         for field in self.required_fields:
@@ -76,19 +169,127 @@ class Mongodb():
                 return False
         query_filter = {"uuid": data.get("uuid")} if data.get("uuid") != "N/A" else {"name": data.get("name")}
         update_operation = {"$set": data}
-        return self.collection_ref.update_one(query_filter, update_operation).acknowledged
+        result = await self.run_blocking(self.collection_ref.update_one, query_filter, update_operation)
+        return result.acknowledged
         
     async def delete(self, data):
         if "uuid" or "name" not in data:
             print("XXX")
             return False
         query_filter = {"uuid": data.get("uuid")} if data.get("uuid") != "N/A" else {"name": data.get("name")}
-        return self.collection_ref.delete_one(query_filter).acknowledged
+        result = await self.run_blocking(self.collection_ref.delete_one, query_filter)
+        return result.acknowledged
 
 
 
-    async def get_all_vms_per_host(self, host_addr):
+    async def get_vms_by_uuid(self, host_addr, uuids, projection=None):
+        # Fetch many VMs of a host in a single $in query -> {uuid: document}
+        if not host_addr or not uuids:
+            return {}
+        query_filter = {"esxi_host_addr": host_addr, "uuid": {"$in": list(set(uuids))}}
+        return await self.run_blocking(self.stream_vm_index, query_filter, projection)
+
+    def stream_vm_index(self, query_filter, projection):
+        # Build the uuid -> record index while the cursor streams, one batch at a time
+        vm_index = {}
+        cursor = self.collection_ref.find(query_filter, projection, batch_size=self.cursor_batch_size)
+        try:
+            for vm in cursor:
+                uuid = vm.get("uuid")
+                if uuid:
+                    vm_index[uuid] = vm
+        finally:
+            cursor.close()
+        return vm_index
+
+    async def get_vm_index_per_host(self, host_addr, projection=None):
+        # Compact {uuid: record} index of a host's VMs holding only the projected fields
         if not host_addr:
-            return []
-        query_filter = {"esxi_host_addr": host_addr}
-        return self.collection_ref.find(query_filter)
\ No newline at end of file
+            return {}
+        return await self.run_blocking(self.stream_vm_index, {"esxi_host_addr": host_addr}, projection)
+
+
+
+    ##############################
+    #            Bulk            #
+    ##############################
+
+    def has_vm_key(self, data):
+        # A bulk write needs the VM's host plus its uuid (or, without one, its name)
+        return bool(data.get("esxi_host_addr")) and any(data.get(field) not in (None, "N/A") for field in ("uuid", "name"))
+
+    def vm_filter(self, data):
+        # Scoped to the VM's host - the same BIOS uuid may exist on several hosts
+        if data.get("uuid") not in (None, "N/A"):
+            return {"esxi_host_addr": data.get("esxi_host_addr"), "uuid": data.get("uuid")}
+        return {"esxi_host_addr": data.get("esxi_host_addr"), "name": data.get("name")}
+
+    # Apply a sync plan ({"add": [...], "update": [...], "orphans": [...]}) as unordered bulk writes keyed on host + uuid
+    # (new VMs are upserted, updates/orphans $set only the fields they carry) -> return success/failure counts per operation type
+    async def bulk_apply(self, plan):
+        kinds = {"add": "added", "update": "updated", "orphans": "orphaned"}
+        counts = {}
+        for result_field in kinds.values():
+            counts[result_field] = 0
+            counts[f"{result_field}_failures"] = 0
+
+        operations = []
+        for kind, result_field in kinds.items():
+            # New VMs must be complete documents, updates/orphans may only carry the changed fields
+            required_fields = self.required_fields if kind == "add" else []
+            for data in plan.get(kind, []):
+                if not all(field in data for field in required_fields) or not self.has_vm_key(data):
+                    print(f"[WARN] Missing required fields in VM data: {data}")
+                    counts[f"{result_field}_failures"] += 1
+                    continue
+                document = {key: value for key, value in data.items() if key != "_id"}
+                operations.append((result_field, UpdateOne(self.vm_filter(data), {"$set": document}, upsert=(kind == "add"))))
+
+        for batch_start in range(0, len(operations), self.bulk_batch_size):
+            batch = operations[batch_start:batch_start + self.bulk_batch_size]
+            failed_indexes = set()
+            try:
+                await self.run_blocking(self.collection_ref.bulk_write, [operation for _, operation in batch], ordered=False)
+            except BulkWriteError as e:
+                failed_indexes = {error["index"] for error in e.details.get("writeErrors", [])}
+                print(f"[ERROR] {len(failed_indexes)} of {len(batch)} bulk operations failed: {e.details.get('writeErrors', [])[:1]}")
+            except PyMongoError as e:
+                failed_indexes = set(range(len(batch)))
+                print(f"[ERROR] Bulk write of {len(batch)} operations failed: {e}")
+
+            for index, (result_field, _) in enumerate(batch):
+                if index in failed_indexes:
+                    counts[f"{result_field}_failures"] += 1
+                else:
+                    counts[result_field] += 1
+
+        return counts
+
+    async def touch_vms(self, host_addr, uuids, sync_time):
+        # Batched liveness bump for VMs that had no changes this cycle
+        if not host_addr or not uuids:
+            return 0
+        query_filter = {"esxi_host_addr": host_addr, "uuid": {"$in": list(uuids)}}
+        try:
+            result = await self.run_blocking(self.collection_ref.update_many, query_filter, {"$set": {"last_sync_time": sync_time}})
+            return result.modified_count
+        except PyMongoError as e:
+            print(f"[ERROR] Failed to update last_sync_time of {len(uuids)} VMs on {host_addr}: {e}")
+            return 0
+
+    async def backfill_content_hashes(self, host_addr, content_hashes):
+        # Store {uuid: content hash} on unchanged VMs whose stored hash is missing or outdated - best effort, retried next cycle
+        if not host_addr or not content_hashes:
+            return 0
+        operations = [
+            UpdateOne({"esxi_host_addr": host_addr, "uuid": uuid, "content_hash": {"$ne": content_hash}}, {"$set": {"content_hash": content_hash}})
+            for uuid, content_hash in content_hashes.items()
+        ]
+        modified = 0
+        for start in range(0, len(operations), self.bulk_batch_size):
+            try:
+                result = await self.run_blocking(self.collection_ref.bulk_write, operations[start:start + self.bulk_batch_size], ordered=False)
+                modified += result.modified_count
+            except PyMongoError as e:
+                print(f"[ERROR] Failed to backfill the content hash of {len(content_hashes)} VMs on {host_addr}: {e}")
+        return modified
@@ -0,0 +1,281 @@
+from pymongo import UpdateOne, ASCENDING
+from pymongo.errors import BulkWriteError, PyMongoError
+from datetime import datetime, timezone
+import asyncio
+import hashlib
+import random
+import time
+import uuid
+
+
+# Downstream targets of a rename entry - an entry is delivered once every target accepted it
+RENAME_TARGETS = ["vm-group-service", "auth-service"]
+
+
+class Outbox():
+    def __init__(self, mongodb_instance, outbox_conf=None):
+        """
+        param:
+            mongodb_instance: The Mongodb instance (the outbox lives next to the VM collection)
+            outbox_conf: Optional outbox configuration (collection, polling, retries, retention)
+        """
+        self.optional_conf = {
+            "collection": "outbox", # Outbox collection name (in the mongodb.db database)
+            "poll_interval": 5, # Seconds between dispatcher passes (the last host run of a cycle also wakes the dispatcher)
+            "batch_size": 500, # Entries claimed per dispatcher pass and kind
+            "lease_seconds": 120, # Seconds a claimed entry is hidden from other dispatchers
+            "retry_backoff": 5, # First retry delay in seconds, doubled per attempt (with jitter)
+            "retry_backoff_max": 300, # Max retry delay in seconds
+            "max_attempts": 50, # Attempts before an entry is parked as 'dead'
+            "retention": 86400 # Seconds delivered entries are kept (TTL index)
+        }
+        self.load_config(outbox_conf or {})
+        self.mongo = mongodb_instance
+        self.collection_ref = mongodb_instance.db_ref[self.collection]
+        self.indexes = {
+            "status_kind_next_attempt": ([("status", ASCENDING), ("kind", ASCENDING), ("next_attempt_at", ASCENDING)], {}),
+            "lease": ([("lease", ASCENDING)], {}),
+            "delivered_at_ttl": ([("delivered_at", ASCENDING)], {"expireAfterSeconds": self.retention})
+        }
+
+    def load_config(self, outbox_conf):
+        for conf, default in self.optional_conf.items():
+            setattr(self, conf, outbox_conf.get(conf, default))
+
+    def create_indexes(self):
+        for index_name, (keys, options) in self.indexes.items():
+            try:
+                self.collection_ref.create_index(keys, name=index_name, **options)
+                print(f"[INIT] MongoDB index ensured: {self.collection}.{index_name}")
+            except PyMongoError as e:
+                print(f"[WARN] Failed to ensure MongoDB index {self.collection}.{index_name}: {e}")
+
+
+    ###################################
+    #             Entries             #
+    ###################################
+
+    def entry(self, entry_id, kind, host, payload, **fields):
+        now = time.time()
+        return {
+            "_id": entry_id, # Idempotency key - also sent downstream as the Idempotency-Key header
+            "kind": kind,
+            "host": host,
+            "payload": payload,
+            "status": "pending",
+            "attempts": 0,
+            "created_at": now,
+            "next_attempt_at": now,
+            "last_error": None,
+            **fields
+        }
+
+    def rename_entries(self, host, renamed_vms):
+        entries = []
+        for renamed in renamed_vms:
+            key = f"rename:{host}:{renamed.get('old_name')}:{renamed.get('new_name')}"
+            entry_id = hashlib.sha1(key.encode()).hexdigest()
+            entries.append(self.entry(entry_id, "rename", host, renamed, pending_targets=list(RENAME_TARGETS)))
+        return entries
+
+    def session_entry(self, host, orphan_data, reactivated_vms, renamed_vms):
+        payload = {
+            "orphans": {orphan["name"]: orphan for orphan in orphan_data if orphan.get("name")},
+            "reactivated": [name for name in reactivated_vms if name],
+            "renames": {renamed.get("old_name"): renamed.get("new_name") for renamed in renamed_vms if renamed.get("old_name")}
+        }
+        if not (payload["orphans"] or payload["reactivated"] or payload["renames"]):
+            return None
+        return self.entry(uuid.uuid4().hex, "sessions", host, payload)
+
+    async def enqueue(self, entries):
+        # Keyed on the idempotency key: a still pending duplicate is skipped (duplicate key error),
+        # a delivered/dead one is queued again -> number of queued entries; raises when an entry could not be queued
+        entries = [entry for entry in entries if entry]
+        if not entries:
+            return 0
+        operations = [
+            UpdateOne(
+                {"_id": entry["_id"], "status": {"$in": ["delivered", "dead"]}},
+                {"$set": {field: value for field, value in entry.items() if field != "_id"}, "$unset": {"delivered_at": "", "lease": ""}},
+                upsert=True
+            )
+            for entry in entries
+        ]
+        try:
+            result = await self.mongo.run_blocking(self.collection_ref.bulk_write, operations, ordered=False)
+            return result.upserted_count + result.modified_count
+        except BulkWriteError as e:
+            errors = [error for error in e.details.get("writeErrors", []) if error.get("code") != 11000]
+            if errors:
+                print(f"[ERROR] Failed to enqueue {len(errors)} of {len(entries)} outbox entries: {errors[:1]}")
+                raise
+            return e.details.get("nUpserted", 0) + e.details.get("nModified", 0)
+
+
+    ###################################
+    #            Delivery             #
+    ###################################
+
+    def claim(self, kind):
+        # Lease due entries so concurrent dispatchers never deliver the same batch at the same time
+        now = time.time()
+        due = {"kind": kind, "status": "pending", "next_attempt_at": {"$lte": now}}
+        ids = [entry["_id"] for entry in self.collection_ref.find(due, {"_id": 1}).sort("next_attempt_at", ASCENDING).limit(self.batch_size)]
+        if not ids:
+            return []
+
+        lease = uuid.uuid4().hex
+        self.collection_ref.update_many(
+            {**due, "_id": {"$in": ids}},
+            {"$set": {"lease": lease, "next_attempt_at": now + self.lease_seconds}}
+        )
+        return list(self.collection_ref.find({"lease": lease}).sort("created_at", ASCENDING))
+
+    def retry_delay(self, attempts):
+        return random.uniform(0.5, 1.0) * min(self.retry_backoff_max, self.retry_backoff * 2 ** max(attempts - 1, 0))
+
+    def settle(self, delivered, failed, error=None, pending_targets=None):
+        # delivered/failed: claimed entries; pending_targets: {entry id: targets still to deliver}
+        now = time.time()
+        operations = [
+            UpdateOne({"_id": entry["_id"]}, {
+                "$set": {"status": "delivered", "delivered_at": datetime.now(timezone.utc), "pending_targets": []},
+                "$unset": {"lease": ""}
+            })
+            for entry in delivered
+        ]
+        for entry in failed:
+            attempts = entry.get("attempts", 0) + 1
+            update = {
+                "status": "dead" if attempts >= self.max_attempts else "pending",
+                "attempts": attempts,
+                "next_attempt_at": now + self.retry_delay(attempts),
+                "last_error": error
+            }
+            if pending_targets and entry["_id"] in pending_targets:
+                update["pending_targets"] = pending_targets[entry["_id"]]
+            operations.append(UpdateOne({"_id": entry["_id"]}, {"$set": update, "$unset": {"lease": ""}}))
+
+        if operations:
+            self.collection_ref.bulk_write(operations, ordered=False)
+
+
+    ###################################
+    #             Metrics             #
+    ###################################
+
+    def stats(self):
+        now = time.time()
+        pipeline = [{"$group": {"_id": {"kind": "$kind", "status": "$status"}, "count": {"$sum": 1}, "oldest": {"$min": "$created_at"}}}]
+        stats = {"pending": 0, "dead": 0, "delivered": 0, "oldest_pending_age": None, "per_kind": {}}
+        for group in self.collection_ref.aggregate(pipeline):
+            kind, status = group["_id"].get("kind"), group["_id"].get("status")
+            stats["per_kind"].setdefault(kind, {})[status] = group["count"]
+            stats[status] = stats.get(status, 0) + group["count"]
+            if status == "pending":
+                age = round(now - group["oldest"], 1)
+                stats["oldest_pending_age"] = max(stats["oldest_pending_age"] or 0, age)
+        return stats
+
+
+class OutboxDispatcher():
+    def __init__(self, outbox, redis_instance, notifier):
+        """
+        param:
+            outbox: The Outbox to drain
+            redis_instance: RedisClient the session changes are applied with
+            notifier: RenameNotifier the renames are delivered with
+        """
+        self.outbox = outbox
+        self.redis = redis_instance
+        self.notifier = notifier
+        self.loop = None
+        self.wake_event = None
+
+    def wake(self):
+        # Called from the sync thread after a cycle - run the next pass now instead of at the next poll
+        if self.loop is not None and self.wake_event is not None:
+            self.loop.call_soon_threadsafe(self.wake_event.set)
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.wake_event = asyncio.Event()
+        print(f"[INFO] Outbox dispatcher started (poll interval {self.outbox.poll_interval}s)")
+        while True:
+            try:
+                await self.dispatch()
+            except Exception as e:
+                print(f"[ERROR] Outbox dispatch failed: {e}")
+            try:
+                await asyncio.wait_for(self.wake_event.wait(), timeout=self.outbox.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wake_event.clear()
+
+    async def dispatch(self):
+        sessions = await self.dispatch_sessions()
+        renames = await self.dispatch_renames()
+        return {"sessions": sessions, "renames": renames}
+
+    def merge_session_changes(self, entries):
+        # Entries are applied oldest first - a later change of the same VM wins, inside one entry a reactivation wins
+        orphans, reactivated, renames = {}, set(), {}
+        for entry in entries:
+            payload = entry.get("payload", {})
+            for name, orphan in payload.get("orphans", {}).items():
+                orphans[name] = orphan
+                reactivated.discard(name)
+            for name in payload.get("reactivated", []):
+                reactivated.add(name)
+                orphans.pop(name, None)
+            renames.update(payload.get("renames", {}))
+        return orphans, reactivated, renames
+
+    async def dispatch_sessions(self):
+        # Every pending session change of every host is applied in a single Redis session sweep
+        entries = await self.outbox.mongo.run_blocking(self.outbox.claim, "sessions")
+        if not entries:
+            return 0
+
+        orphans, reactivated, renames = self.merge_session_changes(entries)
+        try:
+            result = await self.redis.apply_session_changes(orphans, reactivated, renames)
+        except Exception as e:
+            print(f"[ERROR] Failed to apply {len(entries)} outbox session changes: {e}")
+            await self.outbox.mongo.run_blocking(self.outbox.settle, [], entries, str(e))
+            return 0
+
+        print(f"[SESSION SWEEP] {len(orphans)} orphaned, {len(reactivated)} reactivated, {len(renames)} renamed → {result['affected_sessions']} sessions updated")
+        await self.outbox.mongo.run_blocking(self.outbox.settle, entries, [])
+        return len(entries)
+
+    async def dispatch_renames(self):
+        entries = await self.outbox.mongo.run_blocking(self.outbox.claim, "rename")
+        if not entries:
+            return 0
+
+        pending_targets = {entry["_id"]: set(entry.get("pending_targets") or RENAME_TARGETS) for entry in entries}
+        vm_group = [entry for entry in entries if "vm-group-service" in pending_targets[entry["_id"]]]
+        auth = [entry for entry in entries if "auth-service" in pending_targets[entry["_id"]]]
+
+        vm_group_ok, auth_results = await asyncio.gather(
+            self.notifier.notify_vm_group([entry["payload"] for entry in vm_group], [entry["_id"] for entry in vm_group]) if vm_group else asyncio.sleep(0, True),
+            self.notifier.notify_auth([entry["payload"] for entry in auth], [entry["_id"] for entry in auth])
+        )
+        if vm_group_ok:
+            for entry in vm_group:
+                pending_targets[entry["_id"]].discard("vm-group-service")
+        for entry, ok in zip(auth, auth_results):
+            if ok:
+                pending_targets[entry["_id"]].discard("auth-service")
+
+        delivered = [entry for entry in entries if not pending_targets[entry["_id"]]]
+        failed = [entry for entry in entries if pending_targets[entry["_id"]]]
+        await self.outbox.mongo.run_blocking(
+            self.outbox.settle, delivered, failed, "Rename service unavailable",
+            {entry["_id"]: sorted(pending_targets[entry["_id"]]) for entry in failed}
+        )
+        if failed:
+            print(f"[WARN] {len(failed)} of {len(entries)} rename notifications will be retried")
+        return len(delivered)
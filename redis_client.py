@@ -1,9 +1,360 @@
 import redis.asyncio as redis
+from session_codec import SessionCodec
+import asyncio
+import threading
+import time
 import json
 import string
 import random
 
 
+###################################
+#        Session Lua Scripts      #
+###################################
+# Shared helpers + mutations, prepended to the session script. The script runs atomically
+# over a batch of session keys (KEYS) and returns {affected keys, missing keys, renamed old names}
+LUA_SESSION_PRELUDE = """
+local function orphan_name(orphan)
+    if type(orphan) == 'table' then return orphan.name end
+    return orphan
+end
+
+local function as_list(value)
+    if type(value) == 'table' then return value end
+    return {}
+end
+
+-- name -> true lookup of 'vms' names or 'orphans' entries
+local function name_set(entries)
+    local set = {}
+    for _, entry in ipairs(entries) do set[orphan_name(entry)] = true end
+    return set
+end
+
+-- Sessions belong to the auth service and are never re-serialized as a whole: only the values of the
+-- top-level 'vms' and 'orphans' fields are decoded, and only they are replaced in the raw bytes, so every
+-- other field keeps its exact encoding (64-bit ids, empty maps and arrays)
+local OWNED_FIELDS = {vms = true, orphans = true}
+
+local function uint(raw, pos, size)
+    local n = 0
+    for i = pos, pos + size - 1 do n = n * 256 + string.byte(raw, i) end
+    return n
+end
+
+local function uint_bytes(n, size)
+    local bytes = {}
+    for i = size, 1, -1 do
+        bytes[i] = string.char(n % 256)
+        n = math.floor(n / 256)
+    end
+    return table.concat(bytes)
+end
+
+-- End (exclusive) of the JSON value starting at pos
+local function skip_ws(raw, pos)
+    return string.find(raw, '[^ \\t\\r\\n]', pos) or (#raw + 1)
+end
+
+local function json_value_end(raw, pos)
+    local c = string.sub(raw, pos, pos)
+    if c == '"' then
+        local i = pos + 1
+        while true do
+            local q = string.find(raw, '["%\\\\]', i)
+            if not q then error('unterminated JSON string') end
+            if string.sub(raw, q, q) == '"' then return q + 1 end
+            i = q + 2
+        end
+    elseif c == '{' or c == '[' then
+        local depth, i = 0, pos
+        while true do
+            local q = string.find(raw, '[%[%]{}"]', i)
+            if not q then error('unterminated JSON container') end
+            local ch = string.sub(raw, q, q)
+            if ch == '"' then
+                i = json_value_end(raw, q)
+            else
+                depth = depth + ((ch == '{' or ch == '[') and 1 or -1)
+                i = q + 1
+                if depth == 0 then return i end
+            end
+        end
+    end
+    return string.find(raw, '[,}%] \\t\\r\\n]', pos) or (#raw + 1)
+end
+
+-- Element count of the msgpack container at pos (a map counts keys and values) and its header size - nil for scalars
+local function mp_container(raw, pos)
+    local b = string.byte(raw, pos)
+    if b >= 0x80 and b <= 0x8f then return (b - 0x80) * 2, 1 end
+    if b >= 0x90 and b <= 0x9f then return b - 0x90, 1 end
+    if b == 0xdc then return uint(raw, pos + 1, 2), 3 end
+    if b == 0xdd then return uint(raw, pos + 1, 4), 5 end
+    if b == 0xde then return uint(raw, pos + 1, 2) * 2, 3 end
+    if b == 0xdf then return uint(raw, pos + 1, 4) * 2, 5 end
+end
+
+-- msgpack scalars: type byte -> payload size, or -> size of the length prefix (str/bin, ext)
+local MP_FIXED = {[0xcc] = 1, [0xcd] = 2, [0xce] = 4, [0xcf] = 8, [0xd0] = 1, [0xd1] = 2, [0xd2] = 4, [0xd3] = 8,
+                  [0xca] = 4, [0xcb] = 8, [0xd4] = 2, [0xd5] = 3, [0xd6] = 5, [0xd7] = 9, [0xd8] = 17}
+local MP_SIZED = {[0xd9] = 1, [0xda] = 2, [0xdb] = 4, [0xc4] = 1, [0xc5] = 2, [0xc6] = 4}
+local MP_EXT = {[0xc7] = 1, [0xc8] = 2, [0xc9] = 4}
+
+-- End (exclusive) of the msgpack value starting at pos
+local function mp_value_end(raw, pos)
+    local count, size = mp_container(raw, pos)
+    if count then
+        local i = pos + size
+        for _ = 1, count do i = mp_value_end(raw, i) end
+        return i
+    end
+    local b = string.byte(raw, pos)
+    if not b then error('truncated msgpack') end
+    if b <= 0x7f or b >= 0xe0 or b == 0xc0 or b == 0xc2 or b == 0xc3 then return pos + 1 end
+    if b >= 0xa0 and b <= 0xbf then return pos + 1 + b - 0xa0 end
+    if MP_FIXED[b] then return pos + 1 + MP_FIXED[b] end
+    if MP_SIZED[b] then return pos + 1 + MP_SIZED[b] + uint(raw, pos + 1, MP_SIZED[b]) end
+    if MP_EXT[b] then return pos + 2 + MP_EXT[b] + uint(raw, pos + 1, MP_EXT[b]) end
+    error('invalid msgpack')
+end
+
+-- Top-level object of a JSON session -> {field = {first, last + 1}} of the owned fields, layout
+local function json_layout(raw)
+    local spans, fields = {}, 0
+    local pos = skip_ws(raw, 1)
+    if string.sub(raw, pos, pos) ~= '{' then return nil end
+    pos = skip_ws(raw, pos + 1)
+    while string.sub(raw, pos, pos) ~= '}' do
+        local key_end = json_value_end(raw, pos)
+        local key = cjson.decode(string.sub(raw, pos, key_end - 1))
+        pos = skip_ws(raw, key_end)
+        if string.sub(raw, pos, pos) ~= ':' then error('invalid JSON object') end
+        pos = skip_ws(raw, pos + 1)
+        local value_end = json_value_end(raw, pos)
+        if OWNED_FIELDS[key] then spans[key] = {pos, value_end} end
+        fields = fields + 1
+        pos = skip_ws(raw, value_end)
+        if string.sub(raw, pos, pos) == ',' then pos = skip_ws(raw, pos + 1) end
+        if pos > #raw then error('unterminated JSON object') end
+    end
+    return {format = 'json', spans = spans, fields = fields, close = pos}
+end
+
+-- Top-level map of a msgpack session -> same layout (close = end of the map, header = its size)
+local function mp_layout(raw)
+    local b = string.byte(raw, 1)
+    if not ((b >= 0x80 and b <= 0x8f) or b == 0xde or b == 0xdf) then return nil end
+    local count, header = mp_container(raw, 1)
+    local spans, pos = {}, 1 + header
+    for _ = 1, count / 2 do
+        local key_end = mp_value_end(raw, pos)
+        local key = cmsgpack.unpack(string.sub(raw, pos, key_end - 1))
+        local value_end = mp_value_end(raw, key_end)
+        if OWNED_FIELDS[key] then spans[key] = {key_end, value_end} end
+        pos = value_end
+    end
+    if pos ~= #raw + 1 then error('trailing bytes after the msgpack map') end
+    return {format = 'msgpack', spans = spans, fields = count / 2, close = pos, header = header}
+end
+
+-- Sessions are JSON (starting with '{') or msgpack -> {vms, orphans} decoded from the raw value, layout
+local function read_session(raw)
+    local start = skip_ws(raw, 1)
+    local layout
+    if string.sub(raw, start, start) == '{' then
+        layout = json_layout(raw)
+    else
+        layout = mp_layout(raw)
+    end
+    if not layout then return nil end
+    local session = {}
+    for field, span in pairs(layout.spans) do
+        local value = string.sub(raw, span[1], span[2] - 1)
+        session[field] = layout.format == 'json' and cjson.decode(value) or cmsgpack.unpack(value)
+    end
+    return session, layout
+end
+
+-- Encode an owned list in the session's format (an empty list stays an array in both)
+local function encode_list(list, format)
+    if format == 'msgpack' then return cmsgpack.pack(list) end
+    if next(list) == nil then return '[]' end
+    return cjson.encode(list)
+end
+
+local function mp_map_header(fields)
+    if fields <= 15 then return string.char(0x80 + fields) end
+    if fields <= 65535 then return string.char(0xde) .. uint_bytes(fields, 2) end
+    return string.char(0xdf) .. uint_bytes(fields, 4)
+end
+
+-- Replace the owned fields in the raw session, add the ones it did not have
+local function write_session(raw, layout, session)
+    local edits, added = {}, {}
+    for field in pairs(OWNED_FIELDS) do
+        if type(session[field]) == 'table' then
+            local value = encode_list(session[field], layout.format)
+            local span = layout.spans[field]
+            if span then
+                table.insert(edits, {span[1], span[2], value})
+            elseif layout.format == 'json' then
+                table.insert(added, cjson.encode(field) .. ':' .. value)
+            else
+                table.insert(added, cmsgpack.pack(field) .. value)
+            end
+        end
+    end
+
+    local fields = layout.fields + #added
+    if #added > 0 then
+        local text = table.concat(added, layout.format == 'json' and ',' or '')
+        if layout.format == 'json' and layout.fields > 0 then text = ',' .. text end
+        table.insert(edits, {layout.close, layout.close, text})
+    end
+    if layout.format == 'msgpack' and #added > 0 then
+        table.insert(edits, {1, 1 + layout.header, mp_map_header(fields)})
+    end
+
+    -- Splice from the back so earlier positions stay valid
+    table.sort(edits, function(a, b) return a[1] > b[1] end)
+    for _, edit in ipairs(edits) do
+        raw = string.sub(raw, 1, edit[1] - 1) .. edit[3] .. string.sub(raw, edit[2])
+    end
+    return raw
+end
+
+-- The mutations only scan a session until the first match, lookups are built for sessions that change
+local function orphan_vms(session, new_orphans)
+    local vms = as_list(session.vms)
+    local matched = false
+    for _, name in ipairs(vms) do
+        if new_orphans[name] then matched = true break end
+    end
+    if not matched then return false end
+
+    local orphans = as_list(session.orphans)
+    local orphan_names = name_set(orphans)
+    local kept = {}
+    for _, name in ipairs(vms) do
+        if new_orphans[name] then
+            if not orphan_names[name] then
+                table.insert(orphans, new_orphans[name])
+                orphan_names[name] = true
+            end
+        else
+            table.insert(kept, name)
+        end
+    end
+
+    session.vms = kept
+    session.orphans = orphans
+    return true
+end
+
+local function reactivate_vms(session, reactivated)
+    local orphans = as_list(session.orphans)
+    local matched = false
+    for _, orphan in ipairs(orphans) do
+        if reactivated[orphan_name(orphan)] then matched = true break end
+    end
+    if not matched then return false end
+
+    local vms = as_list(session.vms)
+    local allowed = name_set(vms)
+    local kept = {}
+    for _, orphan in ipairs(orphans) do
+        local name = orphan_name(orphan)
+        if reactivated[name] then
+            if not allowed[name] then
+                table.insert(vms, name)
+                allowed[name] = true
+            end
+        else
+            table.insert(kept, orphan)
+        end
+    end
+
+    session.vms = vms
+    session.orphans = kept
+    return true
+end
+
+local function rename_vms(session, renames, renamed, key)
+    local changed = false
+    local vms = as_list(session.vms)
+    for idx, name in ipairs(vms) do
+        if renames[name] then
+            renamed[name] = renamed[name] or {}
+            renamed[name][key] = true
+            vms[idx] = renames[name]
+            changed = true
+        end
+    end
+
+    local orphans = as_list(session.orphans)
+    for idx, orphan in ipairs(orphans) do
+        local name = orphan_name(orphan)
+        if renames[name] then
+            renamed[name] = renamed[name] or {}
+            renamed[name][key] = true
+            if type(orphan) == 'table' then orphan.name = renames[name] else orphans[idx] = renames[name] end
+            changed = true
+        end
+    end
+    return changed
+end
+
+local function mutate_sessions(mutate)
+    local affected, missing = {}, {}
+    for _, key in ipairs(KEYS) do
+        local raw = redis.call('GET', key)
+        if not raw then
+            table.insert(missing, key)
+        else
+            -- Sessions that do not parse are left untouched
+            local ok, session, layout = pcall(read_session, raw)
+            if ok and session and mutate(session, key) then
+                local written, value = pcall(write_session, raw, layout, session)
+                if written then
+                    redis.call('SET', key, value, 'KEEPTTL')
+                    table.insert(affected, key)
+                end
+            end
+        end
+    end
+    return {affected, missing}
+end
+"""
+
+# ARGV[1]: {"orphans": {name: orphan entry}, "reactivated": [names], "renames": {old name: new name}}
+# Every session is read and written at most once, whatever mix of changes it is affected by
+LUA_APPLY_SESSION_CHANGES = LUA_SESSION_PRELUDE + """
+local changes = cjson.decode(ARGV[1])
+local new_orphans = as_list(changes.orphans)
+local reactivated = name_set(as_list(changes.reactivated))
+local renames = as_list(changes.renames)
+local renamed = {}
+
+local result = mutate_sessions(function(session, key)
+    local orphaned = orphan_vms(session, new_orphans)
+    local online = reactivate_vms(session, reactivated)
+    local moved = rename_vms(session, renames, renamed, key)
+    return orphaned or online or moved
+end)
+
+-- {{old name, key, key, ...}, ...}
+local renamed_keys = {}
+for name, keys in pairs(renamed) do
+    local entry = {name}
+    for key in pairs(keys) do table.insert(entry, key) end
+    table.insert(renamed_keys, entry)
+end
+table.insert(result, renamed_keys)
+return result
+"""
+
+
 class RedisClient():
     def __init__(self, redis_conf):
         self.required_conf = [
@@ -11,22 +362,46 @@ class RedisClient():
             "port",
             "session_time"
         ]
+        self.optional_conf = {
+            "index_prefix": "vm_sessions:", # Prefix of the VM name -> session keys reverse index sets
+            "internal_prefixes": ["sync_service:"], # Key prefixes that are not sessions (coordination keys, change stream) - skipped by session scans
+            "batch_size": 500, # Sessions read/written per pipeline
+            "max_connections": 20, # Max connections per event loop - callers wait for a free one instead of opening more
+            "pool_timeout": 10, # Seconds to wait for a free pooled connection
+            "socket_timeout": 5, # Timeout of a single command on an open connection
+            "socket_connect_timeout": 5, # Timeout for establishing a connection
+            "socket_keepalive": True, # TCP keepalive on pooled connections
+            "health_check_interval": 30, # Idle seconds after which a connection is PINGed before reuse
+            "unix_socket_path": None, # Connect over a unix socket instead of host/port
+            "session_index_watcher": True # Index sessions written by other services via keyspace notifications - off: every sweep SCANs all sessions
+        }
         self.check_conf(redis_conf)
+        self.session_codec = SessionCodec()
+
+        # Keys under these prefixes are not sessions (the session index, the coordination keys, the change stream)
+        self.internal_prefixes = [self.index_prefix] + list(self.internal_prefixes)
+
+        # The index only covers sessions written by other services while the watcher runs - until it is
+        # subscribed and has rebuilt the index, sweeps find their sessions with a SCAN
+        self.index_ready = False
         self.connect()
 
 
     ###################################
-    #               CURD              # 
+    #               CURD              #
     ###################################
-    async def update(self, key, value):
-        ttl = await self.client.ttl(key)
-        value = self.serializer(value)
-        return await self.client.setex(key, ttl, value)
-    
     async def get(self, key):
         value = await self.client.get(key)
         return self.deserializer(value)
 
+    async def get_many(self, keys):
+        # One pipeline of GETs -> {key: value} (missing sessions map to None)
+        async with self.client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.get(key)
+            values = await pipe.execute()
+        return {key: self.deserializer(value) for key, value in zip(keys, values)}
+
 
     ###################################
     #               Utils             #
@@ -34,165 +409,331 @@ class RedisClient():
 
     def check_conf(self, redis_conf):
         for conf in self.required_conf:
+            # host/port are not needed when connecting over a unix socket
+            if conf in ("host", "port") and redis_conf.get("unix_socket_path"):
+                setattr(self, conf, redis_conf.get(conf))
+                continue
             if conf not in redis_conf:
                 raise ValueError(f"Missing required configuration for redis service: redis.{conf}")
             setattr(self, conf, redis_conf[conf])
 
+        for conf, default in self.optional_conf.items():
+            setattr(self, conf, redis_conf.get(conf, default))
+
+        if "codec" in redis_conf:
+            print("[WARN] redis.codec is ignored - sessions are rewritten in the format they were written in (JSON or msgpack)")
+
     def connect(self):
-        self.client = redis.Redis(
-            host=self.host,
-            port=self.port,
-            db=0,
-            decode_responses=True
-        )
-
-
-    def serializer(self, value):
-        if type(value) is dict:
-            return json.dumps(value)
-        return value
-    
+        self.pool_conf = {
+            "max_connections": self.max_connections,
+            "timeout": self.pool_timeout,
+            "db": 0,
+            "decode_responses": True,
+            "encoding_errors": "surrogateescape", # msgpack sessions round-trip through str unchanged
+            "socket_timeout": self.socket_timeout,
+            "socket_connect_timeout": self.socket_connect_timeout,
+            "health_check_interval": self.health_check_interval
+        }
+        if self.unix_socket_path:
+            self.pool_conf.update(connection_class=redis.UnixDomainSocketConnection, path=self.unix_socket_path)
+        else:
+            self.pool_conf.update(host=self.host, port=self.port, socket_keepalive=self.socket_keepalive)
+
+        # redis.asyncio connections are bound to the event loop that opened them, so the shared client
+        # keeps one bounded pool per loop (sync worker, API server, session watcher)
+        self.clients = {}
+        self.clients_lock = threading.Lock()
+
+    @property
+    def client(self):
+        return self.loop_client()[0]
+
+    @property
+    def session_changes_script(self):
+        return self.loop_client()[1]
+
+    def loop_client(self):
+        loop = asyncio.get_running_loop()
+        with self.clients_lock:
+            # Pools of closed loops can never be used again
+            for closed_loop in [closed_loop for closed_loop in self.clients if closed_loop.is_closed()]:
+                del self.clients[closed_loop]
+            if loop not in self.clients:
+                client = redis.Redis(connection_pool=redis.BlockingConnectionPool(**self.pool_conf))
+                # Registered scripts run with EVALSHA and are loaded (SCRIPT LOAD) once on the first NOSCRIPT
+                self.clients[loop] = (client, client.register_script(LUA_APPLY_SESSION_CHANGES))
+            return self.clients[loop]
+
+    async def close(self):
+        # Disconnect the pool of the running loop (called before the loop goes away)
+        with self.clients_lock:
+            entry = self.clients.pop(asyncio.get_running_loop(), None)
+        if entry:
+            await entry[0].aclose()
+            await entry[0].connection_pool.disconnect()
+
+
     def deserializer(self, value):
-        try:
-            return json.loads(value)
-        except (json.JSONDecodeError, TypeError):
-            return value
+        return self.session_codec.decode(value)
+
+    def orphan_name(self, orphan):
+        # Orphans are stored as {"name": ..., "orphan_since": ...} but older sessions may hold plain names
+        return orphan.get("name") if isinstance(orphan, dict) else orphan
+
+    def session_vm_names(self, session_data):
+        names = set(session_data.get("vms", []))
+        names.update(self.orphan_name(orphan) for orphan in session_data.get("orphans", []))
+        names.discard(None)
+        return names
+
+
+    def is_session_key(self, key):
+        return not key.startswith(tuple(self.internal_prefixes))
 
-    
     async def get_all_sessions(self):
         cursor = 0
         sessions = []
 
         while True:
+            # Sessions are strings - sets, zsets and streams of other services are never read as sessions
             cursor, keys = await self.client.scan(
                 cursor=cursor,
                 match="*",
-                count=100
+                count=100,
+                _type="string"
             )
 
-            sessions.extend(keys)
+            sessions.extend(key for key in keys if self.is_session_key(key))
 
             if cursor == 0:
                 break
-        
-        return sessions
-    
-
-    async def update_orphans_in_sessions(self, orphan_data):
-        sessions = await self.get_all_sessions()
-        updated_sessions = 0
-
-        new_orphan_names = {vm["name"] for vm in orphan_data if vm.get("name")}
 
-        for session in sessions:
-            session_data = await self.get(session)
-            if not isinstance(session_data, dict):
-                continue
+        return sessions
 
-            allowed_vms = set(session_data.get("vms", []))
-            current_orphans = set(session_data.get("orphans", []))
 
-            current_orphan_names = {o["name"] for o in current_orphans if isinstance(o, dict) and o.get("name")}
+    ###################################
+    #              Health             #
+    ###################################
 
-            orphan_to_add = allowed_vms & new_orphan_names
+    def pool_stats(self):
+        with self.clients_lock:
+            pools = [client.connection_pool for loop, (client, _) in self.clients.items() if not loop.is_closed()]
 
-            if not orphan_to_add:
-                continue
+        stats = []
+        for pool in pools:
+            (idle, _), (in_use, _) = pool.get_connection_count()
+            stats.append({"max_connections": pool.max_connections, "in_use": in_use, "idle": idle})
+        return {
+            "target": self.unix_socket_path or f"{self.host}:{self.port}",
+            "pools": len(stats),
+            "in_use": sum(pool["in_use"] for pool in stats),
+            "idle": sum(pool["idle"] for pool in stats),
+            "per_loop": stats
+        }
 
-            session_data["vms"] = list(allowed_vms - orphan_to_add)
+    async def health(self):
+        start_time = time.monotonic()
+        try:
+            await self.client.ping()
+        except Exception as e:
+            return {"ok": False, "error": str(e), **self.pool_stats()}
+        return {"ok": True, "ping_latency": round(time.monotonic() - start_time, 4), **self.pool_stats()}
 
-            for orphan_vm in orphan_data:
-                name = orphan_vm.get("name")
-                if name in orphan_to_add and name not in current_orphan_names:
-                    current_orphans.append(orphan_vm)
-            
-            session_data["orphans"] = current_orphans
 
+    ###################################
+    #          Session Index          #
+    ###################################
 
+    def index_key(self, vm_name):
+        return f"{self.index_prefix}{vm_name}"
+
+    async def index_session(self, key, session_data):
+        # Register the session under every VM it references; an index set lives as long as its newest session
+        if not isinstance(session_data, dict):
+            return
+        names = self.session_vm_names(session_data)
+        if not names:
+            return
+
+        async with self.client.pipeline(transaction=False) as pipe:
+            self.queue_index(pipe, key, names)
+            await pipe.execute()
+
+    def queue_index(self, pipe, key, vm_names):
+        for name in vm_names:
+            pipe.sadd(self.index_key(name), key)
+            pipe.expire(self.index_key(name), self.session_time)
+
+    async def get_sessions_for_vms(self, vm_names):
+        vm_names = [name for name in vm_names if name]
+        if not vm_names:
+            return []
+        if not self.index_ready:
+            # Incomplete index - every session is a candidate, the session script skips the unaffected ones
+            return await self.get_all_sessions()
+        return list(await self.client.sunion([self.index_key(name) for name in vm_names]))
+
+    async def unindex_sessions(self, keys, vm_names):
+        # Lazily drop sessions that expired or no longer reference the given VMs
+        if not keys:
+            return
+        async with self.client.pipeline(transaction=False) as pipe:
+            for name in vm_names:
+                pipe.srem(self.index_key(name), *keys)
+            await pipe.execute()
+
+    async def rebuild_session_index(self):
+        # Full rebuild from the sessions themselves - for when the index drifted (e.g. sessions written by other services)
+        index = {}
+        for batch in self.batches(await self.get_all_sessions()):
+            for session, session_data in (await self.get_many(batch)).items():
+                if not isinstance(session_data, dict):
+                    continue
+                for name in self.session_vm_names(session_data):
+                    index.setdefault(name, set()).add(session)
+
+        stale_keys = []
+        cursor = 0
+        while True:
+            cursor, keys = await self.client.scan(cursor=cursor, match=f"{self.index_prefix}*", count=100)
+            stale_keys.extend(key for key in keys if key[len(self.index_prefix):] not in index)
+            if cursor == 0:
+                break
 
-            await self.update(session, session_data)
-            updated_sessions += 1
+        async with self.client.pipeline(transaction=True) as pipe:
+            for name, sessions in index.items():
+                pipe.delete(self.index_key(name))
+                pipe.sadd(self.index_key(name), *sessions)
+                pipe.expire(self.index_key(name), self.session_time)
+            if stale_keys:
+                pipe.delete(*stale_keys)
+            await pipe.execute()
 
         return {
             "ok": True,
-            "message": "Orphan VMs updated in active Redis sessions.",
-            "affected_sessions": updated_sessions
+            "message": "Session index rebuilt.",
+            "indexed_vms": len(index),
+            "removed_vms": len(stale_keys)
         }
-    
-    async def move_vms_from_orphans_to_vms(self, reactivated_vms):
-        sessions = await self.get_all_sessions()
-        updated_sessions = 0
 
-        for session in sessions:
-            session_data = self.get(session)
-            if not isinstance(session_data, dict):
-                continue
+    async def keyspace_events_enabled(self):
+        # Keyevent notifications for string commands ('E' plus '$' or 'A') - None when CONFIG is not allowed
+        try:
+            flags = (await self.client.config_get("notify-keyspace-events")).get("notify-keyspace-events", "")
+        except Exception:
+            return None
+        return "E" in flags and ("$" in flags or "A" in flags)
+
+    async def watch_session_writes(self):
+        # Keep the index current for sessions written by other services (requires notify-keyspace-events with 'E$').
+        # Subscribes first and rebuilds after, so no session written in between is missed; any failure
+        # falls back to SCAN sweeps until the watcher is back and has rebuilt the index
+        while True:
+            pubsub = self.client.pubsub()
+            try:
+                await pubsub.subscribe("__keyevent@0__:set")
+                enabled = await self.keyspace_events_enabled()
+                if not enabled:
+                    reason = "lacks 'E$'" if enabled is False else "cannot be checked (CONFIG not allowed)"
+                    print(f"[WARN] Redis notify-keyspace-events {reason} - session sweeps will SCAN every session")
+                    return
+
+                result = await self.rebuild_session_index()
+                self.index_ready = True
+                print(f"[INFO] Session index rebuilt ({result['indexed_vms']} VMs), watching Redis session writes...")
+
+                async for message in pubsub.listen():
+                    if message.get("type") != "message":
+                        continue
+                    key = message.get("data")
+                    if not key or not self.is_session_key(key):
+                        continue
+                    try:
+                        await self.index_session(key, await self.get(key))
+                    except Exception as e:
+                        print(f"[WARN] Failed to index session {key}: {e}")
+            except Exception as e:
+                self.index_ready = False
+                print(f"[WARN] Session index watcher failed, sweeps SCAN until it recovers: {e}")
+                await asyncio.sleep(5)
+            finally:
+                await pubsub.aclose()
 
-            allowed_vms = set(session_data.get("vms", []))
-            current_orphans = set(session_data.get("orphans", []))
 
-            # Determine which of the allowed vms are now online
-            new_online = current_orphans & set(reactivated_vms)
-            if new_online:
-                # Remove them from 'orphans' and add to 'vms'
-                session_data["vms"] = list(allowed_vms + new_online)
-                session_data["orphans"] = list(current_orphans - new_online)
+    ###################################
+    #         Session Updates         #
+    ###################################
 
-                await self.update(session, session_data)
-                updated_sessions += 1
+    def batches(self, keys):
+        for start in range(0, len(keys), self.batch_size):
+            yield keys[start:start + self.batch_size]
+
+    async def run_session_script(self, keys, payload, vm_names):
+        # Run the session script over the keys in batches -> (affected session keys, {renamed old name: session keys})
+        affected = []
+        renamed = {}
+        for batch in self.batches(keys):
+            result = await self.session_changes_script(keys=batch, args=[json.dumps(payload)])
+            affected.extend(result[0])
+            await self.unindex_sessions(result[1], vm_names)
+            for old_name, *renamed_keys in result[2]:
+                renamed.setdefault(old_name, set()).update(renamed_keys)
+        return affected, renamed
+
+    async def apply_session_changes(self, orphans=None, reactivated=None, renames=None):
+        """
+        Single sweep over every session referencing a changed VM - each session is read and written at most once
+        param:
+            orphans: {vm name: orphan entry} of VMs that left their host
+            reactivated: VM names that are online again
+            renames: {old name: new name}
+        """
+        orphans = {name: orphan for name, orphan in (orphans or {}).items() if name}
+        reactivated = {name for name in (reactivated or []) if name}
+        renames = {old_name: new_name for old_name, new_name in (renames or {}).items() if old_name and new_name}
+
+        vm_names = set(orphans) | reactivated | set(renames)
+        sessions = await self.get_sessions_for_vms(vm_names)
+        payload = {"orphans": orphans, "reactivated": list(reactivated), "renames": renames}
+        affected, renamed = await self.run_session_script(sessions, payload, vm_names)
+
+        # Move the renamed sessions from the old names' index sets to the new ones
+        if renamed:
+            async with self.client.pipeline(transaction=False) as pipe:
+                for old_name, keys in renamed.items():
+                    pipe.sadd(self.index_key(renames[old_name]), *keys)
+                    pipe.expire(self.index_key(renames[old_name]), self.session_time)
+                    pipe.srem(self.index_key(old_name), *keys)
+                await pipe.execute()
 
         return {
             "ok": True,
-            "message": "Online VMs updated in active Redis sessions.",
-            "affected_sessions": updated_sessions
+            "message": "Session changes applied.",
+            "affected_sessions": len(affected),
+            "renamed": [{"old_name": old_name, "new_name": renames[old_name]} for old_name in renames if old_name in renamed]
         }
-    
-    
-    async def rename_vm_in_sessions(self, renamed_vms):
-        sessions = await self.get_all_sessions()
-        updated_sessions = 0
-        renamed_pairs = []
-
-        for session in sessions:
-            session_data = await self.get(session)
-            if not isinstance(session_data, dict):
-                continue
-
-            changed = False
-
-            
-            vms = set(session_data.get("vms", []))
-            orphans = set(session_data.get("orphans", []))
-            
-            #  and orphans list
-            for vm in renamed_vms:
-                old_name = vm.get("old_name")
-                new_name = vm.get("new_name")
-                
-                # Update in vms list
-                if old_name in vms:
-                    vms.remove(old_name)
-                    vms.add(new_name)
-                    session_data["vms"] = list(vms)
-                    changed = True
-
-                # Update in orphans list
-                if old_name in orphans:
-                    orphans.remove(old_name)
-                    orphans.add(new_name)
-                    session_data["orphans"] = list(orphans)
-                    changed = True
-
-            if changed:
-                await self.update(session, session_data)
-                renamed_pairs.append({"old_name": old_name, "new_name": new_name})
-                updated_sessions += 1
 
+    async def update_orphans_in_sessions(self, orphan_data):
+        result = await self.apply_session_changes(orphans={vm.get("name"): vm for vm in orphan_data})
+        return {
+            "ok": True,
+            "message": "Orphan VMs updated in active Redis sessions.",
+            "affected_sessions": result["affected_sessions"]
+        }
 
+    async def move_vms_from_orphans_to_vms(self, reactivated_vms):
+        result = await self.apply_session_changes(reactivated=reactivated_vms)
+        return {
+            "ok": True,
+            "message": "Online VMs updated in active Redis sessions.",
+            "affected_sessions": result["affected_sessions"]
+        }
 
+    async def rename_vm_in_sessions(self, renamed_vms):
+        result = await self.apply_session_changes(renames={vm.get("old_name"): vm.get("new_name") for vm in renamed_vms})
         return {
             "ok": True,
-            "message": f"VM name updated in sessions from '{old_name}' to '{new_name}'.",
-            "affected_sessions": updated_sessions,
-            "renamed": renamed_pairs
-        }
\ No newline at end of file
+            "message": "VM names updated in sessions.",
+            "affected_sessions": result["affected_sessions"],
+            "renamed": result["renamed"]
+        }
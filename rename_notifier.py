@@ -0,0 +1,164 @@
+import httpx
+import hashlib
+import asyncio
+import threading
+import random
+import time
+
+
+class RenameNotifier():
+    def __init__(self, endpoints, notifier_conf=None):
+        """
+        param:
+            endpoints: The endpoints configuration (rename URLs of the downstream services)
+            notifier_conf: Optional notifier configuration (concurrency, timeouts, retries, batching)
+        """
+        self.required_endpoints = {
+            "vm-group-service-rename-vm": "vm_group_service_rename_vm",
+            "auth-service-rename-vm": "auth_service_rename_vm"
+        }
+        self.optional_conf = {
+            "max_concurrency": 10, # Max in-flight requests across all downstream services
+            "max_connections": 20, # Max pooled HTTP connections
+            "keepalive_expiry": 30, # Seconds an idle keep-alive connection is kept open
+            "timeout": 10, # Timeout of a single request (connect/read/write)
+            "retries": 3, # Retries of a request failing with a 5xx or a timeout/connection error
+            "backoff_base": 0.5, # First retry delay in seconds, doubled on every retry (with full jitter)
+            "backoff_max": 10, # Max retry delay in seconds
+            "auth_batch_size": 0 # >0 sends the auth service {"vms": [{"name", "new_name"}, ...]} batches instead of one request per VM
+        }
+        self.load_config(endpoints, notifier_conf or {})
+
+        # httpx clients and asyncio semaphores are bound to the event loop they are used on - one of each per loop
+        self.clients = {}
+        self.clients_lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.endpoint_stats = {}
+
+    def load_config(self, endpoints, notifier_conf):
+        for endpoint, attribute in self.required_endpoints.items():
+            if endpoint not in endpoints or not endpoints.get(endpoint):
+                raise ValueError(f"Missing required configurations: endpoints.{endpoint}")
+            setattr(self, attribute, endpoints.get(endpoint))
+
+        for conf, default in self.optional_conf.items():
+            setattr(self, conf, notifier_conf.get(conf, default))
+
+
+    ###################################
+    #             Clients             #
+    ###################################
+
+    def loop_client(self):
+        loop = asyncio.get_running_loop()
+        with self.clients_lock:
+            for closed_loop in [closed_loop for closed_loop in self.clients if closed_loop.is_closed()]:
+                del self.clients[closed_loop]
+            if loop not in self.clients:
+                client = httpx.AsyncClient(
+                    timeout=self.timeout,
+                    limits=httpx.Limits(
+                        max_connections=self.max_connections,
+                        max_keepalive_connections=self.max_connections,
+                        keepalive_expiry=self.keepalive_expiry
+                    )
+                )
+                self.clients[loop] = (client, asyncio.Semaphore(self.max_concurrency))
+            return self.clients[loop]
+
+    async def close(self):
+        # Close the client of the running loop (called before the loop goes away)
+        with self.clients_lock:
+            entry = self.clients.pop(asyncio.get_running_loop(), None)
+        if entry:
+            await entry[0].aclose()
+
+
+    ###################################
+    #            Requests             #
+    ###################################
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def record(self, endpoint, ok, latency, retries, error=None):
+        with self.stats_lock:
+            stats = self.endpoint_stats.setdefault(endpoint, {
+                "requests": 0, "succeeded": 0, "failed": 0, "retries": 0, "total_latency": 0.0, "last_error": None
+            })
+            stats["requests"] += 1
+            stats["succeeded" if ok else "failed"] += 1
+            stats["retries"] += retries
+            stats["total_latency"] += latency
+            if error:
+                stats["last_error"] = error
+
+    async def post(self, endpoint, url, payload, idempotency_key=None):
+        # POST with retries on 5xx/timeouts/connection errors -> True when the service accepted the request
+        client, semaphore = self.loop_client()
+        headers = {"Idempotency-Key": idempotency_key} if idempotency_key else None
+        start_time = time.monotonic()
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(self.backoff(attempt - 1))
+            try:
+                async with semaphore:
+                    response = await client.post(url, json=payload, headers=headers)
+            except (httpx.TimeoutException, httpx.TransportError) as e:
+                error = f"{type(e).__name__}: {e}"
+                continue
+
+            if response.status_code < 300:
+                self.record(endpoint, True, time.monotonic() - start_time, attempt)
+                return True
+            error = f"HTTP {response.status_code}: {response.text[:200]}"
+            if response.status_code < 500:
+                break
+
+        self.record(endpoint, False, time.monotonic() - start_time, attempt, error)
+        print(f"[ERROR] Rename notification to {endpoint} failed after {attempt + 1} attempts: {error}")
+        return False
+
+    def batch_key(self, idempotency_keys):
+        if not idempotency_keys or None in idempotency_keys:
+            return None
+        return hashlib.sha1("|".join(sorted(idempotency_keys)).encode()).hexdigest()
+
+    async def notify_vm_group(self, renamed_vms, idempotency_keys=None):
+        return await self.post("vm-group-service", self.vm_group_service_rename_vm, {"vms": renamed_vms}, self.batch_key(idempotency_keys))
+
+    async def notify_auth(self, renamed_vms, idempotency_keys=None):
+        # One auth request per VM (or per auth_batch_size VMs) -> one delivery result per VM
+        idempotency_keys = idempotency_keys or [None] * len(renamed_vms)
+        renames = [{"name": vm.get("old_name"), "new_name": vm.get("new_name")} for vm in renamed_vms]
+        batch_size = self.auth_batch_size if self.auth_batch_size and self.auth_batch_size > 0 else 0
+
+        requests = []
+        for start in range(0, len(renames), batch_size or 1):
+            if batch_size:
+                end = start + batch_size
+                requests.append((end - start, self.post("auth-service", self.auth_service_rename_vm, {"vms": renames[start:end]}, self.batch_key(idempotency_keys[start:end]))))
+            else:
+                requests.append((1, self.post("auth-service", self.auth_service_rename_vm, renames[start], idempotency_keys[start])))
+
+        results = await asyncio.gather(*(request for _, request in requests))
+        per_vm = []
+        for (size, _), ok in zip(requests, results):
+            per_vm.extend([ok] * size)
+        return per_vm[:len(renamed_vms)]
+
+
+    ###################################
+    #              Stats              #
+    ###################################
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                endpoint: {
+                    **{key: value for key, value in stats.items() if key != "total_latency"},
+                    "avg_latency": round(stats["total_latency"] / stats["requests"], 3) if stats["requests"] else None
+                }
+                for endpoint, stats in self.endpoint_stats.items()
+            }
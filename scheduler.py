@@ -0,0 +1,231 @@
+import threading
+import asyncio
+import random
+import time
+
+
+class HostScheduler():
+    def __init__(self, sync_instances, sync_conf, coordinator=None):
+        """
+        param:
+            sync_instances: The Sync instances to schedule (one per ESXi host)
+            sync_conf: The sync configuration (default interval, jitter, backoff and circuit breaker options)
+            coordinator: Optional HostCoordinator - only hosts leased by this replica are synced
+        """
+        self.required_conf = ["interval"]
+        self.optional_conf = {
+            "jitter": 0.1, # Each run is scheduled interval * (1 ± jitter) apart, so hosts do not log in together
+            "backoff_max": 1800, # Max delay in seconds between runs of a host failing with connect/auth errors
+            "failure_threshold": 3, # Consecutive connect/auth failures that open the host's circuit
+            "circuit_open_seconds": 600, # Seconds an open circuit skips the host before a single probe run
+            "adaptive_interval": False, # Halve the interval of hosts with changes (down to min_interval), double it back when quiet
+            "min_interval": 30, # Shortest adaptive interval in seconds
+            "overlap": "skip" # A host due while its last run is still going: 'skip' the run, 'coalesce' into one follow-up run, 'queue' every run
+        }
+        self.load_config(sync_conf)
+        self.coordinator = coordinator
+        self.lock = threading.Lock()
+        self.forced = set()
+
+        # Bound to the sync worker's event loop on the first wait()
+        self.loop = None
+        self.wake_event = None
+
+        now = time.time()
+        self.hosts = {}
+        for instance in sync_instances:
+            interval = getattr(instance, "interval", None) or self.interval
+            self.hosts[instance.host] = {
+                "instance": instance,
+                "interval": interval, # Configured interval of the host
+                "current_interval": interval, # Interval in use (differs when adaptive_interval is on)
+                "next_run": now + self.jittered(interval),
+                "running": False,
+                "pending_runs": 0, # Runs held back by the overlap policy, started as soon as the current run finishes
+                "circuit": "closed", # closed -> open (after failure_threshold connect/auth failures) -> half_open (one probe)
+                "consecutive_failures": 0,
+                "last_run": None,
+                "last_duration": None,
+                "last_error": None
+            }
+
+    def load_config(self, sync_conf):
+        for conf in self.required_conf:
+            if conf not in sync_conf or not sync_conf.get(conf, None):
+                raise ValueError(f"Missing required configurations in sync: {conf}")
+            setattr(self, conf, sync_conf.get(conf))
+
+        for conf, default in self.optional_conf.items():
+            setattr(self, conf, sync_conf.get(conf, default))
+
+        if self.overlap not in {"skip", "coalesce", "queue"}:
+            raise ValueError(f"Invalid sync overlap policy: {self.overlap} (expected 'skip', 'coalesce' or 'queue')")
+
+
+    ###################################
+    #            Schedule             #
+    ###################################
+
+    def jittered(self, seconds):
+        return seconds * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def seconds_until_next_run(self):
+        with self.lock:
+            waiting = [state["next_run"] for state in self.hosts.values()]
+        if not waiting:
+            return None
+        return max(0, min(waiting) - time.time())
+
+    async def wait(self):
+        # Sleep until the next host is due, a forced sync or a finished run
+        if self.wake_event is None:
+            self.loop = asyncio.get_running_loop()
+            self.wake_event = asyncio.Event()
+        try:
+            await asyncio.wait_for(self.wake_event.wait(), timeout=self.seconds_until_next_run())
+        except asyncio.TimeoutError:
+            pass
+        self.wake_event.clear()
+
+    def wake(self):
+        # Thread-safe - called from the API server's thread as well
+        if self.loop is not None and self.wake_event is not None:
+            self.loop.call_soon_threadsafe(self.wake_event.set)
+
+    def force(self, hosts=None):
+        # The hosts (default: all) run now (running hosts per the overlap policy) - an open circuit gets its probe run early
+        with self.lock:
+            self.forced.update(hosts or self.hosts)
+        self.wake()
+
+    def host_gained(self, host):
+        # A host leased by this replica runs right away instead of after a full interval
+        with self.lock:
+            if host in self.hosts:
+                self.hosts[host]["next_run"] = time.time()
+        self.wake()
+
+    def is_owned(self, host):
+        return self.coordinator is None or self.coordinator.owns(host)
+
+    def hold_back(self, state):
+        # The host is due but still running - apply the overlap policy
+        host = state["instance"].host
+        if self.overlap == "skip":
+            print(f"[SCHEDULER] Skipping a run of {host}: the previous run is still in progress")
+        elif self.overlap == "coalesce":
+            state["pending_runs"] = 1
+        else:
+            state["pending_runs"] += 1
+            print(f"[SCHEDULER] Queued a run of {host} behind the running one ({state['pending_runs']} pending)")
+
+    def take_due(self):
+        # Mark the due hosts as running -> their Sync instances
+        now = time.time()
+        due = []
+        with self.lock:
+            forced, self.forced = self.forced, set()
+            for host, state in self.hosts.items():
+                if host not in forced and state["next_run"] > now:
+                    continue
+
+                # Leased by another replica - check again in one interval
+                if not self.is_owned(host):
+                    state["next_run"] = now + self.jittered(state["current_interval"])
+                    continue
+
+                # Fixed rate: the next run is due one interval after this one started
+                state["next_run"] = now + self.jittered(state["current_interval"])
+                if state["running"]:
+                    self.hold_back(state)
+                    continue
+
+                if state["circuit"] == "open":
+                    state["circuit"] = "half_open"
+                    print(f"[SCHEDULER] Probing {state['instance'].host} (circuit half-open)")
+                state["running"] = True
+                due.append(state["instance"])
+        return due
+
+    def is_running(self):
+        with self.lock:
+            return any(state["running"] for state in self.hosts.values())
+
+    def is_host_running(self, host):
+        with self.lock:
+            return host in self.hosts and self.hosts[host]["running"]
+
+
+    ###################################
+    #             Results             #
+    ###################################
+
+    def is_host_failure(self, result):
+        # Only an unreachable host or rejected login counts towards backoff - DB/Redis errors are not the host's fault
+        return bool(result.get("connect_error") or result.get("timed_out"))
+
+    def has_changes(self, result):
+        return bool(result.get("added") or result.get("updated") or result.get("orphaned"))
+
+    def finished(self, host, result, duration):
+        now = time.time()
+        with self.lock:
+            state = self.hosts[host]
+            state["running"] = False
+            state["last_run"] = now
+            state["last_duration"] = round(duration, 2)
+            state["last_error"] = result.get("connect_error") or result.get("error")
+
+            if self.is_host_failure(result):
+                # Held back runs would hit the same failure - the backoff decides the next run
+                state["pending_runs"] = 0
+                state["consecutive_failures"] += 1
+                delay = min(self.backoff_max, state["current_interval"] * 2 ** state["consecutive_failures"])
+                if state["circuit"] == "half_open" or state["consecutive_failures"] >= self.failure_threshold:
+                    if state["circuit"] != "open":
+                        print(f"[SCHEDULER] Circuit open for {host} after {state['consecutive_failures']} failures, next probe in {self.circuit_open_seconds}s")
+                    state["circuit"] = "open"
+                    delay = max(delay, self.circuit_open_seconds)
+                state["next_run"] = now + self.jittered(delay)
+            else:
+                if state["circuit"] != "closed":
+                    print(f"[SCHEDULER] Circuit closed for {host}")
+                state["circuit"] = "closed"
+                state["consecutive_failures"] = 0
+                if self.adaptive_interval:
+                    previous_interval = state["current_interval"]
+                    if self.has_changes(result):
+                        state["current_interval"] = max(self.min_interval, state["current_interval"] / 2)
+                    else:
+                        state["current_interval"] = min(state["interval"], state["current_interval"] * 2)
+                    state["next_run"] += state["current_interval"] - previous_interval
+
+                if state["pending_runs"]:
+                    state["pending_runs"] -= 1
+                    state["next_run"] = now
+        self.wake()
+
+
+    ###################################
+    #              Stats              #
+    ###################################
+
+    def stats(self):
+        now = time.time()
+        with self.lock:
+            return [
+                {
+                    "host": host,
+                    "owned": self.is_owned(host),
+                    "running": state["running"],
+                    "pending_runs": state["pending_runs"],
+                    "circuit": state["circuit"],
+                    "consecutive_failures": state["consecutive_failures"],
+                    "interval": state["interval"],
+                    "current_interval": round(state["current_interval"], 1),
+                    "next_run_in": round(max(0, state["next_run"] - now), 1),
+                    "last_duration": state["last_duration"],
+                    "last_error": state["last_error"]
+                }
+                for host, state in self.hosts.items()
+            ]
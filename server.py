@@ -1,7 +1,10 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Header
 from pydantic import BaseModel
-from typing import List
-from fastapi.responses import JSONResponse
+from typing import List, Optional
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+import contextlib
+import hashlib
+from jobs import FINISHED_STATUSES
 import uvicorn
 
 class SyncStatus(BaseModel):
@@ -11,28 +14,82 @@ class SyncVMs(BaseModel):
     vms: List[str]
 
 class APIServer:
-    def __init__(self, server_conf, sync_status_getter, force_sync_trigger, sync_instances):
+    def __init__(self, server_conf, sync_status_getter, force_sync_trigger, sync_instances, redis_instance, notifier, outbox, scheduler, coordinator, jobs, changefeed):
         """
         param:
             host: IP address to listen on
             port: port number to listen on
             sync_status_getter: A callable function that returns the value of SYNC_IN_PROCESS
             force_sync_trigger: A callable function that trigger a forced sync
+            redis_instance: The RedisClient shared with the sync instances
+            notifier: The RenameNotifier used by the outbox dispatcher
+            outbox: The Outbox the sync instances queue notifications in
+            scheduler: The HostScheduler deciding when each host is synced
+            coordinator: The HostCoordinator sharding the hosts across replicas
+            jobs: The SyncJobs running POST /sync/vms requests in the background
+            changefeed: The ChangeFeed the sync instances publish applied diffs to
         """
         self.required_conf = ["host", "port"]
         self.load_config(server_conf)
         self.sync_status_getter = sync_status_getter
         self.force_sync_trigger = force_sync_trigger
-        self.app = FastAPI()
+        self.app = FastAPI(lifespan=self.lifespan)
         self.sync_instances = sync_instances
+        self.redis = redis_instance
+        self.notifier = notifier
+        self.outbox = outbox
+        self.scheduler = scheduler
+        self.coordinator = coordinator
+        self.jobs = jobs
+        self.changefeed = changefeed
         self.register_routes()
 
 
+    @contextlib.asynccontextmanager
+    async def lifespan(self, app):
+        yield
+        # Close the Redis pool bound to the server's loop (health checks, change stream mirror of sync jobs)
+        await self.redis.close()
+
     def make_response(self, ok, message, **kwargs):
         response = {"ok": ok, "message": message,}
         response.update(kwargs)
         return JSONResponse(content=response)
 
+    def inventories(self, host=None):
+        # Complete snapshots of the hosts this replica owns - each is read once, so a request sees one consistent version per host.
+        # With sharding, hosts owned by other replicas are only served by those replicas.
+        return [
+            sync.inventory for sync in self.sync_instances
+            if self.coordinator.owns(sync.host) and (host is None or sync.host == host) and sync.inventory.complete
+        ]
+
+    def unserved_hosts(self, snapshots, host=None):
+        # Requested hosts missing from the response (owned by another replica, or not collected yet)
+        served = {snapshot.host for snapshot in snapshots}
+        return [sync.host for sync in self.sync_instances if sync.host not in served and (host is None or sync.host == host)]
+
+    def inventory_etag(self, snapshots, *query):
+        # Changes whenever any served snapshot is replaced, or the query differs
+        versions = [(snapshot.host, snapshot.generation) for snapshot in snapshots]
+        return '"' + hashlib.sha1(repr((versions, query)).encode()).hexdigest() + '"'
+
+    def not_modified(self, etag, if_none_match):
+        return if_none_match is not None and etag in [tag.strip() for tag in if_none_match.split(",")]
+
+    def feed_offset(self, offset, last_event_id):
+        # Resume after ?offset= or the SSE Last-Event-ID header (an event id), else start at the latest event
+        # -> (offset, the resume id when it was unknown)
+        event_id = offset if offset is not None else last_event_id
+        if event_id is None:
+            return self.changefeed.latest_offset(), None
+        resumed, known = self.changefeed.resume_offset(event_id)
+        return resumed, None if known else event_id
+
+    def feed_filter(self, values):
+        # Comma separated query value -> set (None = no filter)
+        return {value.strip() for value in values.split(",") if value.strip()} if values else None
+
 
     def load_config(self, server_conf):
         for conf in self.required_conf:
@@ -50,13 +107,14 @@ class APIServer:
             ) 
         
         @self.app.get("/sync/now")
-        def force_sync():
+        def force_sync(host: Optional[str] = None):
             status = None
             
             if self.sync_status_getter():
                 status = "already syncing"
             
-            self.force_sync_trigger()
+            # Sharded replicas route the trigger to the replica owning the host
+            self.force_sync_trigger([host] if host else None)
             
             status =  "sync triggered"
             
@@ -65,27 +123,147 @@ class APIServer:
                 message=status
             )
         
+        @self.app.get("/sync/schedule")
+        async def get_schedule():
+            return self.make_response(
+                ok=True,
+                message="Sync schedule checked successfully",
+                data=self.scheduler.stats()
+            )
+
+        @self.app.get("/sync/cluster")
+        async def get_cluster():
+            return self.make_response(
+                ok=True,
+                message="Replica membership checked successfully",
+                data=self.coordinator.stats()
+            )
+
+        @self.app.get("/sync/sessions")
+        async def get_sessions_stats():
+            return self.make_response(
+                ok=True,
+                message="ESXi session stats checked successfully",
+                data=[sync.sessions.stats() for sync in self.sync_instances]
+            )
+
+        @self.app.get("/sync/redis")
+        async def get_redis_health():
+            health = await self.redis.health()
+            return self.make_response(
+                ok=health["ok"],
+                message="Redis health checked successfully" if health["ok"] else "Redis is unreachable",
+                data=health
+            )
+
+        @self.app.get("/sync/notifier")
+        async def get_notifier_stats():
+            return self.make_response(
+                ok=True,
+                message="Rename notifier stats checked successfully",
+                data=self.notifier.stats()
+            )
+
+        @self.app.get("/sync/outbox")
+        async def get_outbox_stats():
+            return self.make_response(
+                ok=True,
+                message="Outbox stats checked successfully",
+                data=await self.outbox.mongo.run_blocking(self.outbox.stats)
+            )
+
         @self.app.post("/sync/vms")
-        async def sync_vms(payload: SyncVMs):
-            status = None
-            results = []
-            
-            if self.sync_status_getter():
-                status = "already syncing"
-            
-            if not status:
-                status =  "sync triggered"
-                for sync in self.sync_instances:
-                    result = await sync.sync_selected_vms(payload.vms)
-                results.append({sync.host: result})
+        async def sync_vms(payload: SyncVMs, wait: float = 0):
+            # Queued as a background job - 'wait' holds the response up to that many seconds for the result
+            job = await self.jobs.wait(self.jobs.submit(payload.vms), wait)
+            finished = job["status"] in FINISHED_STATUSES
+            return self.make_response(
+                ok=job["status"] in {"queued", "running", "succeeded"},
+                message=f"sync job {job['status']}" if finished else "sync job queued",
+                data=self.jobs.view(job)
+            )
 
-            
+        @self.app.get("/sync/jobs/{job_id}")
+        async def get_sync_job(job_id: str, wait: float = 0):
+            job = self.jobs.get(job_id)
+            if job is None:
+                return self.make_response(ok=False, message=f"sync job {job_id} not found")
+            job = await self.jobs.wait(job, wait)
             return self.make_response(
-                ok=(status != "already syncing"),
-                message=status,
-                data=results
+                ok=job["status"] in {"queued", "running", "succeeded"},
+                message=f"sync job {job['status']}",
+                data=self.jobs.view(job)
             )
 
+        @self.app.get("/sync/changes")
+        async def get_changes(offset: Optional[str] = None, limit: int = 500, host: Optional[str] = None, types: Optional[str] = None, wait: float = 0):
+            # Polling form of the change feed - 'wait' long-polls up to that many seconds for the first event
+            offset, unknown_id = self.feed_offset(offset, None)
+            if wait:
+                await self.changefeed.wait(offset, wait)
+            events, missed = self.changefeed.read(offset, limit)
+            hosts, change_types = self.feed_filter(host), self.feed_filter(types)
+            return self.make_response(
+                ok=True,
+                message="Change feed checked successfully",
+                data=[event for event in events if self.changefeed.matches(event, hosts, change_types)],
+                next_offset=events[-1]["id"] if events else self.changefeed.event_id(offset + missed),
+                missed=missed,
+                gap=unknown_id is not None or missed > 0,
+                feed=self.changefeed.stats()
+            )
+
+        @self.app.get("/sync/changes/stream")
+        async def stream_changes(offset: Optional[str] = None, host: Optional[str] = None, types: Optional[str] = None, last_event_id: Optional[str] = Header(None)):
+            # Server-Sent Events - reconnecting clients resume through Last-Event-ID
+            resume_offset, unknown_id = self.feed_offset(offset, last_event_id)
+            return StreamingResponse(
+                self.changefeed.stream(resume_offset, self.feed_filter(host), self.feed_filter(types), unknown_id),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            )
+
+        @self.app.get("/vms")
+        async def get_vms(host: Optional[str] = None, name: Optional[str] = None, power_state: Optional[str] = None, offset: int = 0, limit: int = 100, if_none_match: Optional[str] = Header(None)):
+            # Served from the in-memory inventory - no ESXi or MongoDB round trip
+            snapshots = self.inventories(host)
+            etag = self.inventory_etag(snapshots, host, name, power_state, offset, limit)
+            if self.not_modified(etag, if_none_match):
+                return Response(status_code=304, headers={"ETag": etag})
+
+            matched = [(snapshot.host, record) for snapshot in snapshots for record in snapshot.select(name, power_state)]
+            response = self.make_response(
+                ok=True,
+                message="VM inventory checked successfully",
+                data=[record.to_dict(vm_host) for vm_host, record in matched[offset:offset + limit]],
+                total=len(matched),
+                offset=offset,
+                limit=limit,
+                hosts=[snapshot.stats() for snapshot in snapshots],
+                unserved_hosts=self.unserved_hosts(snapshots, host)
+            )
+            response.headers["ETag"] = etag
+            return response
+
+        @self.app.get("/vms/{uuid}")
+        async def get_vm(uuid: str, if_none_match: Optional[str] = Header(None)):
+            snapshots = self.inventories()
+            etag = self.inventory_etag(snapshots, uuid)
+            if self.not_modified(etag, if_none_match):
+                return Response(status_code=304, headers={"ETag": etag})
+
+            for snapshot in snapshots:
+                record = snapshot.get(uuid)
+                if record is not None:
+                    response = self.make_response(ok=True, message="VM checked successfully", data=record.to_dict(snapshot.host))
+                    break
+            else:
+                unserved = self.unserved_hosts(snapshots)
+                message = f"VM {uuid} not found" + (f" (hosts not served by this replica: {', '.join(unserved)})" if unserved else "")
+                response = self.make_response(ok=False, message=message, unserved_hosts=unserved)
+            response.headers["ETag"] = etag
+            return response
+
     
     def run(self):
         uvicorn.run(self.app, host=self.host, port=self.port)
\ No newline at end of file
@@ -0,0 +1,45 @@
+import json
+
+# Optional - orjson speeds up JSON decoding, msgpack is needed to read sessions other services write as msgpack
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class SessionCodec():
+    # Read side only: this service never writes a whole session - the Lua sweep rewrites vms/orphans in the
+    # format each session was written in by its owner
+
+
+    ###################################
+    #             Decode              #
+    ###################################
+
+    def decode(self, value):
+        # Values arrive as str (binary payloads are surrogate-escaped by the client) - JSON and plain values start
+        # with an ASCII character, a msgpack map never does
+        if not isinstance(value, str) or not value:
+            return value
+        if msgpack is not None and value[0] > "\x7f":
+            return self.decode_msgpack(value)
+        return self.decode_json(value)
+
+    def decode_json(self, value):
+        try:
+            if orjson is not None:
+                return orjson.loads(value)
+            return json.loads(value)
+        except ValueError:
+            return value
+
+    def decode_msgpack(self, value):
+        try:
+            return msgpack.unpackb(value.encode("utf-8", "surrogateescape"), raw=False)
+        except (ValueError, msgpack.UnpackException):
+            return value
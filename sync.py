@@ -1,22 +1,81 @@
-from pyVim.connect import SmartConnect, Disconnect
-from pyVmomi import vim
+from pyVim.connect import SmartConnect
+from pyVmomi import vim, vmodl
+from esxi_session import EsxiSessionPool
+from inventory import InventorySnapshot
 import ssl
 from datetime import datetime
 import socket
 from typing import List
-import httpx
+import concurrent.futures
+import functools
+import hashlib
+import json
 import asyncio
+import threading
+import re
+
+# Properties fetched per VM by the PropertyCollector - exactly what vm_struct needs
+VM_PROPERTIES = ["name", "config.uuid", "guest.hostName", "guest.ipAddress", "guest.toolsStatus", "runtime.powerState"]
+
+# VM document fields compared between ESXi and the DB - a change in any of them triggers a write
+TRACKED_FIELDS = ["name", "hostname", "addr", "power_state", "vmware_tools", "orphan"]
+
+# DB fields loaded for the diff - everything else stays on the server
+DIFF_PROJECTION = {field: 1 for field in TRACKED_FIELDS + ["uuid", "orphan_since", "content_hash"]}
+DIFF_PROJECTION["_id"] = 0
+
+# VM ids of this shape are looked up with SearchIndex.FindByUuid, everything else as a VM name
+UUID_PATTERN = re.compile(r"^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$")
 
 class Sync:
-    def __init__(self, esxi_conf, mongodb_instance, redis_instance, endpoints):
+    def __init__(self, esxi_conf, mongodb_instance, redis_instance, outbox, changefeed):
         self.required_conf = ["host", "port", "username", "password"]
-        self.required_endpoints = ["vm-group-service-rename-vm", "auth-service-rename-vm"]
+        self.optional_conf = {
+            "collection_mode": "bulk", # 'bulk' uses the PropertyCollector, 'legacy' walks every VM object
+            "page_size": 500, # Max VMs returned per RetrievePropertiesEx/ContinueRetrievePropertiesEx page
+            "sync_mode": "full", # 'full' re-enumerates every cycle, 'incremental' applies WaitForUpdatesEx changes only
+            "update_wait_seconds": 0, # How long WaitForUpdatesEx blocks waiting for changes (0 = poll)
+            "max_sessions": 2, # Max concurrent authenticated sessions kept against the host
+            "session_validate_after": 30, # Idle seconds after which a pooled session is validated before reuse
+            "session_acquire_timeout": 60, # Seconds to wait for a free pooled session
+            "liveness": "touch", # Unchanged VMs: 'touch' bumps last_sync_time in one batched write, 'skip' writes nothing
+            "interval": None, # Sync interval of this host in seconds (defaults to sync.interval)
+            "http_timeout": 60 # Socket timeout of pyVmomi calls - bounds calls abandoned by a timed out run (keep above update_wait_seconds)
+        }
         self.load_config(esxi_conf)
-        self.load_endpoints(endpoints)
         self.context = ssl._create_unverified_context() # Disable SSL cert warnings (for self-signed ESXi certs)
         self.mongo = mongodb_instance
         self.redis = redis_instance
-        self.endpoints = endpoints
+        self.outbox = outbox
+        self.changefeed = changefeed
+        self.sessions = EsxiSessionPool(
+            self.host,
+            connect=self.get_service_instance,
+            max_sessions=self.max_sessions,
+            validate_after=self.session_validate_after,
+            acquire_timeout=self.session_acquire_timeout
+        )
+        # Blocking pyVmomi calls run here, off the event loop (one worker per session slot)
+        self.executor = self.create_executor()
+
+        # Incremental sync state (kept between cycles)
+        self.update_session = None
+        self.update_collector = None
+        self.update_container = None
+        self.update_filter = None
+        self.update_version = None
+        self.vm_properties_cache = {} # VM moref id -> last known properties
+        self.vm_name_index = {} # VM name -> moref id, refreshed by every bulk collection (targeted lookups)
+
+        # Last collected inventory, served by GET /vms (replaced as a whole, so reads need no lock)
+        self.inventory = InventorySnapshot(self.host)
+        self.inventory_lock = threading.Lock()
+
+        # Kind of the last failed login ('auth', 'timeout', 'network', 'unknown') - read by the HostScheduler
+        self.connect_error = None
+
+        # HostCoordinator, set by main once it exists - a run whose lease was lost meanwhile must not write
+        self.coordinator = None
 
     def load_config(self, esxi_conf):
         for conf in self.required_conf:
@@ -24,76 +83,82 @@ class Sync:
                 raise ValueError(f"Missing required configurations in esxi host under esxi_hosts configurations: {conf}")
             setattr(self, conf, esxi_conf.get(conf))
 
-    def load_endpoints(self, endpoints):
-        for endpoint in self.required_endpoints:
-            if endpoint not in endpoints or not endpoints.get(endpoint):
-                raise ValueError(f"Missing required configurations: endpoints.{endpoint}")
-            setattr(self, endpoint, endpoints.get(endpoint).replace("-", "_"))
-                
+        for conf, default in self.optional_conf.items():
+            setattr(self, conf, esxi_conf.get(conf, default))
+
+        if self.collection_mode not in {"bulk", "legacy"}:
+            raise ValueError(f"Invalid collection_mode for esxi host {self.host}: {self.collection_mode} (expected 'bulk' or 'legacy')")
+
+        if self.liveness not in {"touch", "skip"}:
+            raise ValueError(f"Invalid liveness for esxi host {self.host}: {self.liveness} (expected 'touch' or 'skip')")
+
+        if self.sync_mode not in {"full", "incremental"}:
+            raise ValueError(f"Invalid sync_mode for esxi host {self.host}: {self.sync_mode} (expected 'full' or 'incremental')")
 
 
     
     def get_service_instance(self):
         try:
-            return SmartConnect(
+            service_instance = SmartConnect(
                 host=self.host,
                 port=self.port,
                 user=self.username,
                 pwd=self.password,
-                sslContext=self.context
+                sslContext=self.context,
+                httpConnectionTimeout=self.http_timeout
             )
+            self.connect_error = None
+            return service_instance
         except vim.fault.InvalidLogin as e:
+            self.connect_error = "auth"
             print(f"[AUTH ERROR] Invalid credentials for {self.host}: {e}")
         except socket.timeout as e:
+            self.connect_error = "timeout"
             print(f"[TIMEOUT] Connection timed out for {self.host}: {e}")
         except (socket.error, ConnectionRefusedError) as e:
+            self.connect_error = "network"
             print(f"[NETWORK ERROR] Cannot reach {self.host}: {e}")
         except Exception as e:
+            self.connect_error = "unknown"
             print(f"[UNKNOWN ERROR] Error connecting to {self.host}: {e}")
         
+    def create_executor(self):
+        return concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_sessions,
+            thread_name_prefix=f"esxi-{self.host}"
+        )
+
+    async def run_blocking(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args))
+
+    def abandon_inflight(self):
+        # After a cancelled run: pyVmomi calls still blocked in the old executor finish there (bounded by http_timeout),
+        # the next run gets fresh workers instead of queueing behind them
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = self.create_executor()
+
+        # The update filter may be mid-WaitForUpdatesEx - rebuild incremental tracking from a full pass
+        self.update_version = None
+
     def time_gen(self):
         return datetime.now().strftime("%d-%m-%Y: %H:%M:%S")
     
 
-    async def rename_handler(self, renamed_vms):
-        await self.redis.rename_vm_in_sessions(renamed_vms)
-        
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            tasks = []
+    def update_inventory(self, vms=None, changed=(), removed=()):
+        # vms: a full collection; changed/removed: a partial one (nothing changed keeps the generation and the ETags)
+        if vms is None and not changed and not removed:
+            return
+        with self.inventory_lock:
+            if vms is not None:
+                self.inventory = self.inventory.replaced(vms)
+            else:
+                self.inventory = self.inventory.updated(changed, removed)
 
-            # Call to VM Group Service
-            try:
-                tasks.append(client.post(
-                    self.vm_group_service_rename_vm,
-                    json={"vms": renamed_vms}
-                ))
-            except Exception as e:
-                print(f"[ERROR] Failed to call VM Group rename service: {e}")
-
-            # Individual calls to Auth Service
-            for rename_vm in renamed_vms:
-                try:
-                    tasks.append(client.post(
-                        self.auth_service_rename_vm,
-                        json={"name": rename_vm.get("old_name"), "new_name": rename_vm.get("new_name")}
-                    ))
-                except Exception as e:
-                    print(f"[ERROR] Failed to call VM Group rename service: {e}")
-
-        # Handle responses
-        try:
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-            for idx, res in enumerate(results):
-                if isinstance(res, Exception):
-                    print(f"[ERROR] Rename service #{idx+1} failed: {res}")
-                elif res.status_code != 200:
-                    print(f"[WARN] Rename service #{idx+1} responded with {res.status_code}: {res.text}")
-                else:
-                    print(f"[INFO] Rename service #{idx+1} succeeded: {res.json()}")
-        except Exception as e:
-            print(f"[FATAL] Unexpected error during rename service calls: {e}")
+    def content_hash(self, vm):
+        payload = json.dumps([vm.get(field) for field in TRACKED_FIELDS], default=str)
+        return hashlib.sha1(payload.encode()).hexdigest()
 
-    
     def compare_changes(self, db_vm, esxi_vm):
         result = esxi_vm.copy()
         final_result = {}
@@ -102,7 +167,13 @@ class Sync:
             if result[field] == "unknown":
                 result[field] = db_vm.get(field, "unknown")
 
-        final_result.update({"result": result})
+        # Field level diff - skipped entirely when the stored content hash still matches
+        result["content_hash"] = self.content_hash(result)
+        changes = {}
+        if db_vm.get("content_hash") != result["content_hash"]:
+            changes = {field: result.get(field) for field in TRACKED_FIELDS if db_vm.get(field) != result.get(field)}
+
+        final_result.update({"result": result, "changes": changes})
 
         # Detect name change
         old_name = db_vm.get("name")
@@ -116,8 +187,19 @@ class Sync:
         return final_result
 
 
-        
-
+    def change_events(self, db_vm, vm, changes, renamed):
+        # Typed change events of one updated VM - each changed fact is published once
+        events = []
+        if renamed:
+            events.append(self.changefeed.event("renamed", self.host, vm, **renamed))
+        if changes.get("orphan") is False:
+            events.append(self.changefeed.event("reactivated", self.host, vm))
+        if "power_state" in changes:
+            events.append(self.changefeed.event("power_changed", self.host, vm, old=db_vm.get("power_state"), new=changes["power_state"]))
+        other = {field: {"old": db_vm.get(field), "new": value} for field, value in changes.items() if field in {"hostname", "addr", "vmware_tools"}}
+        if other:
+            events.append(self.changefeed.event("updated", self.host, vm, changes=other))
+        return events
 
     def vm_struct(self, name, hostname, addr, uuid, power_state, vmware_tools, orphan=False, orphan_since=None):
         return {
@@ -133,67 +215,353 @@ class Sync:
             "last_sync_time": self.time_gen()
         }
 
-    def get_esxi_vm_list(self):
-        output = []
+    def power_state_gen(self, power_state):
+        return 'on' if power_state == "poweredOn" else "off" if power_state == "poweredOff" else power_state
+
+    def vm_filter_spec(self, container):
+        # Traverse the container view and select only VM_PROPERTIES of each VM
+        traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(
+            name="traverseEntities",
+            path="view",
+            skip=False,
+            type=vim.view.ContainerView
+        )
+        object_spec = vmodl.query.PropertyCollector.ObjectSpec(
+            obj=container,
+            skip=True,
+            selectSet=[traversal_spec]
+        )
+        property_spec = vmodl.query.PropertyCollector.PropertySpec(
+            type=vim.VirtualMachine,
+            pathSet=VM_PROPERTIES,
+            all=False
+        )
+        return vmodl.query.PropertyCollector.FilterSpec(
+            objectSet=[object_spec],
+            propSet=[property_spec]
+        )
+
+    def create_vm_container(self, content):
+        return content.viewManager.CreateContainerView(
+            content.rootFolder,
+            [vim.VirtualMachine],
+            True
+        )
+
+    def retrieve_properties(self, property_collector, filter_spec):
+        # Paged RetrievePropertiesEx -> (VM moref, {property: value})
+        options = vmodl.query.PropertyCollector.RetrieveOptions(maxObjects=self.page_size)
+        result = property_collector.RetrievePropertiesEx([filter_spec], options)
+        while result:
+            for obj in result.objects:
+                yield obj.obj, {prop.name: prop.val for prop in obj.propSet}
+
+            if not result.token:
+                break
+            result = property_collector.ContinueRetrievePropertiesEx(result.token)
+
+    def retrieve_vm_properties(self, content):
+        # Single paged PropertyCollector traversal over a container view of all VMs
+        container = self.create_vm_container(content)
 
-        # Connect to ESXi
-        service_instance = self.get_service_instance()
-        if not service_instance: return []
-        
         try:
-            # Retrieve the content
-            content = service_instance.RetrieveContent()
-
-            # Get all VMs
-            container = content.viewManager.CreateContainerView(
-                content.rootFolder,
-                [vim.VirtualMachine],
-                True
+            yield from self.retrieve_properties(content.propertyCollector, self.vm_filter_spec(container))
+        finally:
+            container.Destroy()
+
+    def vm_from_properties(self, properties):
+        uuid = properties.get("config.uuid")
+        if not uuid:
+            print(f"[WARN] VM {properties.get('name')} has no config.")
+            return None
+
+        return self.vm_struct(
+            name=properties.get("name"),
+            hostname=properties.get("guest.hostName") or "unknown",
+            addr=properties.get("guest.ipAddress") or "unknown",
+            uuid=uuid,
+            power_state=self.power_state_gen(properties.get("runtime.powerState")),
+            vmware_tools=str(properties.get("guest.toolsStatus"))
+        )
+
+    def collect_vms(self, content):
+        output = []
+        name_index = {}
+        for vm, properties in self.retrieve_vm_properties(content):
+            name_index[properties.get("name")] = vm._moId
+            vm_data = self.vm_from_properties(properties)
+            if vm_data:
+                output.append(vm_data)
+        self.vm_name_index = name_index
+        return output
+
+    def resolve_vms(self, session, vm_ids):
+        # UUIDs through the SearchIndex, names through the name index -> {moref id: moref}
+        search_index = session.content.searchIndex
+        stub = session.service_instance._stub
+        vms = {}
+        for vm_id in vm_ids:
+            vm = None
+            if UUID_PATTERN.match(vm_id):
+                vm = search_index.FindByUuid(None, vm_id, True, False)
+            if vm is None and vm_id in self.vm_name_index:
+                vm = vim.VirtualMachine(self.vm_name_index[vm_id], stub)
+            if vm is not None:
+                vms[vm._moId] = vm
+        return vms
+
+    def find_vms(self, session, vm_ids):
+        # Targeted collection: properties of the resolved VMs only, in one PropertyCollector call
+        if self.collection_mode == "legacy":
+            return self.walk_vms(session.content)
+
+        vms = self.resolve_vms(session, vm_ids)
+        output = []
+        if vms:
+            property_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.VirtualMachine, pathSet=VM_PROPERTIES, all=False)
+            filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+                objectSet=[vmodl.query.PropertyCollector.ObjectSpec(obj=vm, skip=False) for vm in vms.values()],
+                propSet=[property_spec]
             )
-            vms = container.view
+            try:
+                for vm, properties in self.retrieve_properties(session.content.propertyCollector, filter_spec):
+                    vm_data = self.vm_from_properties(properties)
+                    if vm_data:
+                        output.append(vm_data)
+            except vmodl.fault.ManagedObjectNotFound:
+                # A cached moref of a deleted VM - resolve everything through a full enumeration
+                return self.collect_vms(session.content)
+
+        # A UUID the SearchIndex does not know is not on this host (selected VMs are looked up on every host).
+        # A name never seen, or a cached name whose VM was renamed since, may be new or renamed - enumerate the host
+        found = {vm["uuid"] for vm in output} | {vm["name"] for vm in output}
+        unresolved = {vm_id for vm_id in vm_ids if vm_id not in found and not UUID_PATTERN.match(vm_id)}
+        if unresolved:
+            print(f"[INFO] {len(unresolved)} of {len(vm_ids)} VMs not resolved by lookup on {self.host}, enumerating the host")
+            return self.collect_vms(session.content)
+        return output
 
-            # Iterate through the VMs in order to get their state and UUIDs
-            for vm in vms:
-                if not vm.config:
-                    print(f"[WARN] VM {vm.name} has no config.")
-                    continue
+    def get_selected_vms(self, vm_ids):
+        try:
+            return self.sessions.call(lambda session: self.find_vms(session, vm_ids))
+        except Exception as e:
+            print(f"[ERROR] Failed to retrieve the selected VMs from {self.host}: {e}")
+            return []
 
-                try:
-                    if vm and vm.config:
-                        uuid = vm.config.uuid
-                    else:
-                        continue
-                except AttributeError:
-                    print(f"VM {vm.name} has no UUID attribute!")
-                    uuid = "N/A"
+    def walk_vms(self, content):
+        output = []
+
+        # Get all VMs
+        container = content.viewManager.CreateContainerView(
+            content.rootFolder,
+            [vim.VirtualMachine],
+            True
+        )
+        vms = container.view
+
+        # Iterate through the VMs in order to get their state and UUIDs
+        for vm in vms:
+            if not vm.config:
+                print(f"[WARN] VM {vm.name} has no config.")
+                continue
+
+            try:
+                if vm and vm.config:
+                    uuid = vm.config.uuid
+                else:
                     continue
-                
-                vm_data = self.vm_struct(
-                    name=vm.name,
-                    hostname=vm.guest.hostName if vm.guest and vm.guest.hostName else "unknown",
-                    addr=vm.guest.ipAddress if vm.guest and vm.guest.ipAddress else "unknown",
-                    uuid=uuid,
-                    power_state='on' if vm.runtime.powerState == "poweredOn" else "off" if vm.runtime.powerState == "poweredOff" else vm.runtime.powerState,
-                    vmware_tools=str(vm.guest.toolsStatus) if vm.guest else "unknown"
-                )
-                output.append(vm_data)
+            except AttributeError:
+                print(f"VM {vm.name} has no UUID attribute!")
+                uuid = "N/A"
+                continue
+
+            vm_data = self.vm_struct(
+                name=vm.name,
+                hostname=vm.guest.hostName if vm.guest and vm.guest.hostName else "unknown",
+                addr=vm.guest.ipAddress if vm.guest and vm.guest.ipAddress else "unknown",
+                uuid=uuid,
+                power_state=self.power_state_gen(vm.runtime.powerState),
+                vmware_tools=str(vm.guest.toolsStatus) if vm.guest else "unknown"
+            )
+            output.append(vm_data)
 
+        return output
+
+    def list_vms(self, session):
+        if self.collection_mode == "legacy":
+            return self.walk_vms(session.content)
+        return self.collect_vms(session.content)
+
+    def get_esxi_vm_list(self):
+        try:
+            return self.sessions.call(self.list_vms)
         except Exception as e:
             print(f"[ERROR] Failed to retrieve VMs from {self.host}: {e}")
-        finally:
-            if service_instance: Disconnect(service_instance)
-        return output
-    
+            return []
+
+    ##############################
+    #      Incremental Sync      #
+    ##############################
+
+    def start_update_tracking(self):
+        # Create a dedicated PropertyCollector + filter and seed the cache from the initial update set
+        self.stop_update_tracking()
+
+        # The filter lives in the session, so it is held for as long as tracking is active
+        self.update_session = self.sessions.acquire()
+        content = self.update_session.content
+        self.update_collector = content.propertyCollector.CreatePropertyCollector()
+        self.update_container = self.create_vm_container(content)
+        self.update_filter = self.update_collector.CreateFilter(self.vm_filter_spec(self.update_container), partialUpdates=True)
+        self.update_version = ""
+
+        self.wait_for_vm_updates()
+
+        esxi_vms = []
+        for properties in self.vm_properties_cache.values():
+            vm_data = self.vm_from_properties(properties)
+            if vm_data:
+                esxi_vms.append(vm_data)
+        return esxi_vms
+
+    def stop_update_tracking(self):
+        healthy = True
+        for obj in (self.update_filter, self.update_container, self.update_collector):
+            try:
+                if obj: obj.Destroy()
+            except Exception:
+                healthy = False
+
+        # Return the session to the pool, or drop it if it is no longer usable
+        if self.update_session:
+            if healthy:
+                self.sessions.release(self.update_session)
+            else:
+                self.sessions.discard(self.update_session)
+
+        self.update_session = None
+        self.update_collector = None
+        self.update_container = None
+        self.update_filter = None
+        self.update_version = None
+        self.vm_properties_cache = {}
+
+    def wait_for_vm_updates(self):
+        # Drain all pending update sets since the last version -> return (changed moref ids, properties of removed VMs)
+        changed = set()
+        left = []
+        options = vmodl.query.PropertyCollector.WaitOptions(
+            maxWaitSeconds=self.update_wait_seconds,
+            maxObjectUpdates=self.page_size
+        )
+
+        while True:
+            update_set = self.update_collector.WaitForUpdatesEx(self.update_version, options)
+            if update_set is None:
+                break
+
+            self.update_version = update_set.version
+            for filter_update in update_set.filterSet:
+                for object_update in filter_update.objectSet:
+                    moref = object_update.obj._moId
+
+                    if object_update.kind == "leave":
+                        changed.discard(moref)
+                        properties = self.vm_properties_cache.pop(moref, None)
+                        if properties:
+                            left.append(properties)
+                        continue
+
+                    properties = {} if object_update.kind == "enter" else self.vm_properties_cache.get(moref, {})
+                    for change in object_update.changeSet:
+                        if change.op in {"remove", "indirectRemove"}:
+                            properties.pop(change.name, None)
+                        else:
+                            properties[change.name] = change.val
+
+                    self.vm_properties_cache[moref] = properties
+                    if properties.get("name"):
+                        self.vm_name_index[properties["name"]] = moref
+                    changed.add(moref)
+
+            if not update_set.truncated:
+                break
+
+        return changed, left
+
+    async def build_incremental_plan(self, changed, left):
+        # Turn enter/modify/leave updates into the same add/update/orphan plan as compare_vms_against_db
+        vms_to_add = []
+        vms_to_update = []
+
+        changed_vms = [self.vm_from_properties(self.vm_properties_cache[moref]) for moref in changed]
+        changed_vms = [vm for vm in changed_vms if vm]
+        left_uuids = [properties.get("config.uuid") for properties in left if properties.get("config.uuid")]
+        self.update_inventory(changed=changed_vms, removed=left_uuids)
+
+        # Single $in lookup for every VM touched by this update set
+        db_vm_dict = await self.mongo.get_vms_by_uuid(self.host, [vm["uuid"] for vm in changed_vms] + left_uuids, projection=DIFF_PROJECTION)
+
+        for vm_data in changed_vms:
+            db_vm = db_vm_dict.get(vm_data["uuid"])
+            if db_vm:
+                vms_to_update.append((vm_data, db_vm))
+            else:
+                vms_to_add.append(vm_data)
+
+        orphans = [db_vm_dict[uuid] for uuid in left_uuids if uuid in db_vm_dict]
+
+        return {
+            "orphans": orphans,
+            "add": vms_to_add,
+            "update": vms_to_update,
+        }
+
+    async def resync_incremental(self):
+        # Full sync pass seeded from a fresh update filter
+        try:
+            esxi_vms = await self.run_blocking(self.start_update_tracking)
+        except Exception as e:
+            print(f"[ERROR] Failed to start update tracking on {self.host}: {e}")
+            await self.run_blocking(self.stop_update_tracking)
+            return await self.sync_vms()
+
+        result = await self.sync_vms(esxi_vms=esxi_vms)
+        result["mode"] = "full"
+        return result
+
+    async def sync_vms_incremental(self):
+        if self.update_version is None:
+            return await self.resync_incremental()
+
+        try:
+            changed, left = await self.run_blocking(self.wait_for_vm_updates)
+        except Exception as e:
+            print(f"[WARN] Lost update tracking on {self.host}, falling back to a full sync: {e}")
+            return await self.resync_incremental()
+
+        data_to_sync = await self.build_incremental_plan(changed, left)
+        result = await self.apply_sync_plan(data_to_sync)
+        result["mode"] = "incremental"
+
+        # Changes may have been lost - rebuild from a full pass next cycle
+        if not result["ok"]:
+            await self.run_blocking(self.stop_update_tracking)
+        return result
+
+    async def sync_cycle(self):
+        if self.sync_mode == "incremental":
+            return await self.sync_vms_incremental()
+        return await self.sync_vms()
 
     async def compare_vms_against_db(self, esxi_vms):
-        db_vms = await self.mongo.get_all_vms_per_host(self.host)
         orphans = []
         vms_to_add = []
         vms_to_update = []
         
 
-        # Create dictionaries for fast access by UUID
-        db_vm_dict = {vm.get("uuid"): vm for vm in db_vms if vm.get("uuid")}
+        # Create dictionaries for fast access by UUID (the DB side is streamed with only the diff fields)
+        db_vm_dict = await self.mongo.get_vm_index_per_host(self.host, projection=DIFF_PROJECTION)
         esxi_vm_dict = {vm.get("uuid"): vm for vm in esxi_vms if vm.get("uuid")}
 
         db_vms_uuids = set(db_vm_dict.keys())
@@ -203,19 +571,14 @@ class Sync:
         # Orphans: in DB but not on host anymore
         orphan_uuids = db_vms_uuids - esxi_vms_uuids
         orphans = [db_vm_dict[uuid] for uuid in orphan_uuids]
-        orphan_data = [{"name": vm.get("name"), "orphan_since": vm.get("orphan_since")} for vm in orphans if vm.get("name")]
-        
+
         # To Add: in ESXi but not in DB
         add_uuids = esxi_vms_uuids - db_vms_uuids
         vms_to_add = [esxi_vm_dict[uuid] for uuid in add_uuids]
 
-        # To Update: exists in both, but may have differences
+        # To Update: exists in both, but may have differences (paired with the matched DB document)
         common_uuids = db_vms_uuids & esxi_vms_uuids
-        vms_to_update = [esxi_vm_dict[uuid] for uuid in common_uuids]
-
-        # Update sessions with orphans vms
-        if len(orphan_data) > 0:
-            await self.redis.update_orphans_in_sessions(orphan_data)
+        vms_to_update = [(esxi_vm_dict[uuid], db_vm_dict[uuid]) for uuid in common_uuids]
 
         return {
             "orphans": orphans,
@@ -224,65 +587,67 @@ class Sync:
         }
     
 
-    async def sync_vms(self):
-        esxi_vms = self.get_esxi_vm_list()
-        ok = True
-        reactivated_vms = []
-        renamed_vms = []
-        successfully_added = 0
-        successfully_orphaned = 0
-        successfully_updated = 0
-        added_failures = 0
-        updated_failures = 0
-        orphaned_failures = 0
-        
+    async def sync_vms(self, esxi_vms=None):
+        if esxi_vms is None:
+            esxi_vms = await self.run_blocking(self.get_esxi_vm_list)
+
         if not esxi_vms:
-            return {"ok": not ok, "added": 0, "updated": 0, "orphaned": 0}
+            return {"ok": False, "added": 0, "updated": 0, "orphaned": 0, "connect_error": self.connect_error}
+        self.update_inventory(vms=esxi_vms)
         
         data_to_sync = await self.compare_vms_against_db(esxi_vms)
+        return await self.apply_sync_plan(data_to_sync)
+
+    def change_struct(self, uuid, changes, content_hash):
+        # Partial document holding only the changed fields of an existing VM (host + uuid select the document)
+        return {"esxi_host_addr": self.host, "uuid": uuid, **changes, "content_hash": content_hash, "last_sync_time": self.time_gen()}
+
+    async def apply_sync_plan(self, data_to_sync):
+        orphan_data = []
+        reactivated_vms = []
+        renamed_vms = []
+        updated_failures = 0
+        unchanged_uuids = []
+        stale_hashes = {} # uuid -> content hash of unchanged VMs stored without it (or with an outdated one)
+        modified_fields = {}
+        vms_to_add = []
+        vms_to_orphan = []
+        vms_to_update = []
+        events = [] # Change feed events of this plan
 
         # Create
         for vm in data_to_sync.get("add", []):
-            created = await self.mongo.create(vm)
-            if not created:
-                added_failures+=1
-                print(f"[ERROR] Failed to create a new vm {vm} in the DB.")
-                ok = False
-            else:
-                successfully_added+=1
+            vm["content_hash"] = self.content_hash(vm)
+            vms_to_add.append(vm)
+            events.append(self.changefeed.event("added", self.host, vm, power_state=vm.get("power_state"), hostname=vm.get("hostname"), addr=vm.get("addr")))
         
         # Orphans
         for vm in data_to_sync.get("orphans", []):
-            if not vm.get("orphan", False):
-                vm["orphan"] = True
-                vm["orphan_since"] = self.time_gen()
-            
-            vm["last_sync_time"] = self.time_gen()
-            updated = await self.mongo.update(vm)
-            if not updated:
-                orphaned_failures+=1
-                print(f"[ERROR] Failed to update an orphaned vm {vm} in the DB.")
-                ok = False
-            else:
-                successfully_orphaned+=1
+            # Already orphaned - its sessions were swept when it was orphaned, nothing to queue again
+            if vm.get("orphan", False) and vm.get("orphan_since"):
+                unchanged_uuids.append(vm.get("uuid"))
+                continue
+
+            orphaned_vm = {**vm, "orphan": True}
+            changes = {"orphan": True, "orphan_since": self.time_gen()}
+            orphan_data.append({"name": vm.get("name"), "orphan_since": changes["orphan_since"]})
+            vms_to_orphan.append(self.change_struct(vm.get("uuid"), changes, self.content_hash(orphaned_vm)))
+            events.append(self.changefeed.event("orphaned", self.host, vm, orphan_since=changes["orphan_since"]))
 
         
-        # update
-        for vm in data_to_sync.get("update", []):
+        # update - each ESXi VM comes paired with its DB document from the diff stage
+        for vm, db_vm in data_to_sync.get("update", []):
             vm_uuid = vm.get("uuid", None)
             vm_name = vm.get("name", None)
             if not vm_uuid or vm_uuid == "N/A" and not vm_name:
                 updated_failures+=1
                 print(f"[ERROR] Cannot update vm in db because the following vms attributes are missing: ['name', 'uuid'] - vm details: {vm}")
-                ok = False
                 continue
-            
-            db_vm = await self.mongo.get(uuid=vm_uuid, name=vm_name)
-
 
             compare_results = self.compare_changes(db_vm=db_vm, esxi_vm=vm)
             renamed = compare_results.get("rename")
             updated_vm = compare_results.get("result")
+            changes = compare_results.get("changes")
 
             if renamed:
                 renamed_vms.append(renamed)
@@ -290,67 +655,129 @@ class Sync:
 
             # ✅ Check for reactivation
             if db_vm.get("orphan") is True:
-                updated_vm["orphan"] = False
-                updated_vm["orphan_since"] = None
+                changes["orphan"] = False
+                changes["orphan_since"] = None
                 reactivated_vms.append(updated_vm.get("name"))
 
+            if not changes:
+                unchanged_uuids.append(vm_uuid)
+                if db_vm.get("content_hash") != updated_vm["content_hash"]:
+                    stale_hashes[vm_uuid] = updated_vm["content_hash"]
+                continue
 
-            updated = await self.mongo.update(updated_vm)
-            if not updated:
-                updated_failures+=1
-                print(f"[ERROR] Failed to update an orphaned vm {vm} in the DB.")
-                ok = False
-            else:
-                successfully_updated+=1
+            for field in changes:
+                if field in TRACKED_FIELDS:
+                    modified_fields[field] = modified_fields.get(field, 0) + 1
+            vms_to_update.append(self.change_struct(vm_uuid, changes, updated_vm["content_hash"]))
+            events.extend(self.change_events(db_vm, updated_vm, changes, renamed))
 
 
-        # Call here handle reactivation function
-        if reactivated_vms:
-            await self.redis.move_vms_from_orphans_to_vms(reactivated_vms)
+        # Session changes and rename notifications go through the outbox, delivered by the OutboxDispatcher
+        outbox_entries = self.outbox.rename_entries(self.host, renamed_vms) + [self.outbox.session_entry(self.host, orphan_data, reactivated_vms, renamed_vms)]
 
-        #Call here handle reactivation function
-        if renamed_vms:
-            await self.rename_handler(renamed_vms)
+        # Shielded: a timed out run is cancelled before or after the write, never between the VM write and its outbox entries
+        counts, queued = await asyncio.shield(self.write_sync_plan({
+            "add": vms_to_add,
+            "orphans": vms_to_orphan,
+            "update": vms_to_update
+        }, outbox_entries, events))
+        counts["updated_failures"] += updated_failures
+        ok = not (counts["added_failures"] or counts["updated_failures"] or counts["orphaned_failures"])
+        if not ok:
+            print(f"[ERROR] Failed to write some VMs of {self.host} to the DB: {counts}")
+
+        # Liveness of unchanged VMs - one batched write or nothing at all
+        if unchanged_uuids and self.liveness == "touch":
+            await self.mongo.touch_vms(self.host, unchanged_uuids, self.time_gen())
+        # Documents written before content hashes existed get one once, so their next diffs take the hash shortcut
+        await self.mongo.backfill_content_hashes(self.host, stale_hashes)
 
         return {
             "ok": ok,
-            "added": successfully_added,
-            "updated": successfully_updated,
-            "orphaned": successfully_orphaned,
-            "added_failures": added_failures,
-            "updated_failures": updated_failures,
-            "orphaned_failures": orphaned_failures,
+            **counts,
+            "unchanged": len(unchanged_uuids),
+            "modified_fields": modified_fields,
             "reactivated": reactivated_vms,
-            "renamed": renamed_vms
+            "renamed": renamed_vms,
+            "notifications_queued": queued
         }
     
+    def check_lease(self):
+        # Sharded: the host may have been claimed by another replica while this run collected - its run writes instead
+        if self.coordinator is not None and not self.coordinator.owns(self.host):
+            # Incremental tracking already consumed the updates of this run - start from a full pass when regained
+            self.update_version = None
+            raise RuntimeError(f"Lease of {self.host} lost during the run, nothing written")
+
+    async def write_sync_plan(self, plan, outbox_entries, events):
+        # Queue the notifications before the VM write: once Mongo holds a new name the rename is never detected again,
+        # while notifications queued for a write that then fails are re-detected next cycle (a still pending duplicate
+        # is skipped by its idempotency key). A failed enqueue raises, so nothing is written this cycle.
+        self.check_lease()
+        queued = await self.outbox.enqueue(outbox_entries)
+        counts = await self.mongo.bulk_apply(plan)
+        # Change events are published also after a partial write failure - a retried diff may publish twice, but no change goes unannounced
+        await self.changefeed.publish(events)
+        return counts, queued
+
     async def sync_selected_vms(self, vm_ids: List[str]):
-        esxi_vms = self.get_esxi_vm_list()
+        vm_ids = set(vm_ids)
+        esxi_vms = await self.run_blocking(self.get_selected_vms, vm_ids)
         selected_vms = [vm for vm in esxi_vms if vm["uuid"] in vm_ids or vm["name"] in vm_ids]
+        self.update_inventory(changed=selected_vms)
         if not selected_vms:
-            return {"ok": True, "matched": 0, "synced": 0}
-        added = updated = failed = 0
+            return {"ok": True, "host": self.host, "matched": 0, "synced": 0, "vms": []}
+        vms_to_add = []
+        vms_to_update = []
+        vm_statuses = [] # Outcome per VM, so coalesced API jobs can each pick their own VMs
+        events = []
+        reactivated_vms = []
+        renamed_vms = []
+        db_vm_dict = await self.mongo.get_vms_by_uuid(self.host, [vm["uuid"] for vm in selected_vms], projection=DIFF_PROJECTION)
+        unchanged = 0
+        stale_hashes = {}
         for vm in selected_vms:
-            db_vm = await self.mongo.get(uuid=vm["uuid"], name=vm["name"])
+            db_vm = db_vm_dict.get(vm["uuid"])
             if db_vm:
-                updated_vm = self.compare_changes(db_vm=db_vm, esxi_vm=vm).get("result")
-                success = await self.mongo.update(updated_vm)
-                if success:
-                    updated+=1
-                else:
-                    failed += 1
+                compare_results = self.compare_changes(db_vm=db_vm, esxi_vm=vm)
+                changes = compare_results.get("changes")
+                if not changes:
+                    unchanged += 1
+                    vm_statuses.append({"uuid": vm["uuid"], "name": vm["name"], "status": "unchanged"})
+                    if db_vm.get("content_hash") != compare_results["result"]["content_hash"]:
+                        stale_hashes[vm["uuid"]] = compare_results["result"]["content_hash"]
+                    continue
+                # Renames and reactivations reach the sessions and the rename services like in a full cycle
+                if compare_results.get("rename"):
+                    renamed_vms.append(compare_results["rename"])
+                if db_vm.get("orphan") is True:
+                    changes["orphan_since"] = None
+                    reactivated_vms.append(vm["name"])
+                vms_to_update.append(self.change_struct(vm["uuid"], changes, compare_results["result"]["content_hash"]))
+                events.extend(self.change_events(db_vm, compare_results["result"], changes, compare_results.get("rename")))
+                vm_statuses.append({"uuid": vm["uuid"], "name": vm["name"], "status": "updated"})
             else:
-                success = await self.mongo.create(vm)
-                if success:
-                    added += 1
-                else:
-                    failed += 1
+                vm["content_hash"] = self.content_hash(vm)
+                vms_to_add.append(vm)
+                events.append(self.changefeed.event("added", self.host, vm, power_state=vm.get("power_state"), hostname=vm.get("hostname"), addr=vm.get("addr")))
+                vm_statuses.append({"uuid": vm["uuid"], "name": vm["name"], "status": "added"})
+
+        outbox_entries = self.outbox.rename_entries(self.host, renamed_vms) + [self.outbox.session_entry(self.host, [], reactivated_vms, renamed_vms)]
+        counts, queued = await asyncio.shield(self.write_sync_plan({"add": vms_to_add, "update": vms_to_update}, outbox_entries, events))
+        failed = counts["added_failures"] + counts["updated_failures"]
+        await self.mongo.backfill_content_hashes(self.host, stale_hashes)
 
         return {
             "ok": failed == 0,
             "host": self.host,
             "matched": len(selected_vms),
-            "added": added,
-            "updated": updated,
-            "failed": failed
-        }
\ No newline at end of file
+            "added": counts["added"],
+            "updated": counts["updated"],
+            "unchanged": unchanged,
+            "failed": failed,
+            "reactivated": reactivated_vms,
+            "renamed": renamed_vms,
+            "notifications_queued": queued,
+            "vms": vm_statuses
+        }
+
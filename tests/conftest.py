@@ -0,0 +1,28 @@
+import os
+import sys
+
+import pytest
+import redis
+
+# The service modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The session script needs a real Redis (cjson, cmsgpack, KEEPTTL) - point REDIS_URL at a scratch database
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/15")
+KEY_PREFIX = "test_session_script:"
+
+
+@pytest.fixture
+def redis_server():
+    client = redis.Redis.from_url(REDIS_URL)
+    try:
+        client.ping()
+    except redis.ConnectionError:
+        pytest.skip(f"needs a Redis server at {REDIS_URL} (set REDIS_URL)")
+
+    yield client
+
+    keys = list(client.scan_iter(match=f"{KEY_PREFIX}*"))
+    if keys:
+        client.delete(*keys)
+    client.close()
@@ -0,0 +1,180 @@
+import json
+
+import pytest
+
+from conftest import KEY_PREFIX
+from redis_client import LUA_APPLY_SESSION_CHANGES
+
+# Only needed to write and read the msgpack sessions of the tests
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+needs_msgpack = pytest.mark.skipif(msgpack is None, reason="needs the msgpack package")
+
+ORPHAN_SINCE = "2025-10-10 08:00:00"
+
+
+def orphan(name):
+    return {"name": name, "orphan_since": ORPHAN_SINCE}
+
+def sweep(client, keys, orphans=(), reactivated=(), renames=None):
+    # One run of the session script -> [affected keys, missing keys, [[old name, key, ...], ...]]
+    payload = {"orphans": {name: orphan(name) for name in orphans}, "reactivated": list(reactivated), "renames": renames or {}}
+    return client.register_script(LUA_APPLY_SESSION_CHANGES)(keys=keys, args=[json.dumps(payload)])
+
+
+###################################
+#          JSON sessions          #
+###################################
+
+def test_json_escapes_and_unicode_survive(redis_server):
+    key = f"{KEY_PREFIX}json-escapes"
+    head = '{"user": "O\'Brien \\"admin\\" \\u00e9", "path": "a\\/b\\\\c", "note": "line\\nbreak \\u2028 日本", '
+    tail = ', "uid": 18446744073709551615, "ratio": 0.1000000000000000055511151231257827, "empty_map": {}, "empty_list": []}'
+    raw = head + '"vms": ["vm \\"quoted\\"", "vm-日本", "vm-keep"], "orphans": []' + tail
+    redis_server.set(key, raw.encode())
+
+    affected, missing, _ = sweep(redis_server, [key], orphans=['vm "quoted"', "vm-日本"])
+
+    assert affected == [key.encode()] and missing == []
+    written = redis_server.get(key).decode()
+    # Only the vms/orphans values are replaced - every other field keeps its exact bytes
+    assert written.startswith(head) and written.endswith(tail)
+    session = json.loads(written)
+    assert session["vms"] == ["vm-keep"]
+    assert session["orphans"] == [orphan('vm "quoted"'), orphan("vm-日本")]
+
+def test_json_missing_orphans_field_is_added(redis_server):
+    key = f"{KEY_PREFIX}json-no-orphans"
+    redis_server.set(key, b'{"user": "a", "vms": ["vm-1", "vm-2"]}')
+
+    sweep(redis_server, [key], orphans=["vm-1"])
+
+    written = redis_server.get(key).decode()
+    assert written.startswith('{"user": "a", ')
+    assert json.loads(written) == {"user": "a", "vms": ["vm-2"], "orphans": [orphan("vm-1")]}
+
+def test_json_reactivating_every_orphan_leaves_an_empty_array(redis_server):
+    key = f"{KEY_PREFIX}json-reactivate"
+    redis_server.set(key, json.dumps({"vms": [], "orphans": [orphan("vm-1")], "prefs": {}}).encode())
+
+    sweep(redis_server, [key], reactivated=["vm-1"])
+
+    written = redis_server.get(key).decode()
+    assert '"orphans": []' in written and '"prefs": {}' in written
+    assert json.loads(written) == {"vms": ["vm-1"], "orphans": [], "prefs": {}}
+
+def test_json_nested_vms_keys_are_untouched(redis_server):
+    nested = f"{KEY_PREFIX}json-nested"
+    only_nested = f"{KEY_PREFIX}json-only-nested"
+    head = '{"meta": {"vms": ["vm-1"], "orphans": []}, "label": "\\"vms\\": [\\"vm-1\\"]", '
+    redis_server.set(nested, (head + '"vms": ["vm-1"]}').encode())
+    redis_server.set(only_nested, b'{"meta": {"vms": ["vm-1"]}, "label": "\\"vms\\": [\\"vm-1\\"]"}')
+
+    affected, _, _ = sweep(redis_server, [nested, only_nested], orphans=["vm-1"])
+
+    assert affected == [nested.encode()]
+    written = redis_server.get(nested).decode()
+    assert written.startswith(head)
+    assert json.loads(written)["meta"] == {"vms": ["vm-1"], "orphans": []}
+    assert json.loads(written)["vms"] == [] and json.loads(written)["orphans"] == [orphan("vm-1")]
+    assert redis_server.get(only_nested) == b'{"meta": {"vms": ["vm-1"]}, "label": "\\"vms\\": [\\"vm-1\\"]"}'
+
+def test_json_renames_report_their_sessions(redis_server):
+    key = f"{KEY_PREFIX}json-rename"
+    redis_server.set(key, json.dumps({"vms": ["vm-1"], "orphans": [orphan("vm-2"), "vm-3"]}).encode())
+
+    _, _, renamed = sweep(redis_server, [key], renames={"vm-1": "vm-1b", "vm-2": "vm-2b", "vm-3": "vm-3b"})
+
+    assert sorted(renamed) == [[b"vm-1", key.encode()], [b"vm-2", key.encode()], [b"vm-3", key.encode()]]
+    assert json.loads(redis_server.get(key)) == {"vms": ["vm-1b"], "orphans": [orphan("vm-2b"), "vm-3b"]}
+
+
+###################################
+#         msgpack sessions        #
+###################################
+
+def msgpack_session(**fields):
+    return {
+        "user": "é",
+        "uid": 2 ** 64 - 1,
+        "ratio": 0.1,
+        "blob": b"\x00\xff",
+        "empty_map": {},
+        "empty_list": [],
+        **fields
+    }
+
+@needs_msgpack
+def test_msgpack_session_keeps_other_fields(redis_server):
+    key = f"{KEY_PREFIX}msgpack"
+    session = msgpack_session(vms=["vm-1", "vm-2"], orphans=[])
+    raw = msgpack.packb(session, use_bin_type=True)
+    redis_server.set(key, raw)
+
+    affected, _, _ = sweep(redis_server, [key], orphans=["vm-1"])
+
+    assert affected == [key.encode()]
+    written = redis_server.get(key)
+    head = raw[:raw.index(msgpack.packb("vms"))]
+    assert written.startswith(head)
+    assert msgpack.unpackb(written, raw=False) == {**session, "vms": ["vm-2"], "orphans": [orphan("vm-1")]}
+
+@needs_msgpack
+def test_msgpack_empty_lists_stay_arrays(redis_server):
+    key = f"{KEY_PREFIX}msgpack-empty"
+    redis_server.set(key, msgpack.packb(msgpack_session(vms=["vm-1"], orphans=[orphan("vm-2")]), use_bin_type=True))
+
+    sweep(redis_server, [key], orphans=["vm-1"], reactivated=["vm-2"])
+    sweep(redis_server, [key], reactivated=["vm-1"])
+
+    session = msgpack.unpackb(redis_server.get(key), raw=False)
+    assert session["vms"] == ["vm-2", "vm-1"]
+    assert session["orphans"] == [] and isinstance(session["orphans"], list)
+    assert session["empty_map"] == {} and session["empty_list"] == []
+
+@needs_msgpack
+def test_msgpack_missing_orphans_field_grows_the_map_header(redis_server):
+    # 15 fields fill a fixmap - adding 'orphans' needs a map16 header
+    key = f"{KEY_PREFIX}msgpack-grow"
+    session = {f"field-{i}": i for i in range(14)}
+    session["vms"] = ["vm-1", "vm-2"]
+    raw = msgpack.packb(session, use_bin_type=True)
+    assert raw[0] == 0x8f
+    redis_server.set(key, raw)
+
+    sweep(redis_server, [key], orphans=["vm-2"])
+
+    written = redis_server.get(key)
+    assert written[0] == 0xde
+    assert msgpack.unpackb(written, raw=False) == {**session, "vms": ["vm-1"], "orphans": [orphan("vm-2")]}
+
+
+###################################
+#           Keys and TTL          #
+###################################
+
+@needs_msgpack
+def test_ttl_is_preserved(redis_server):
+    expiring = f"{KEY_PREFIX}ttl"
+    persistent = f"{KEY_PREFIX}no-ttl"
+    redis_server.set(expiring, json.dumps({"vms": ["vm-1"]}).encode(), ex=1000)
+    redis_server.set(persistent, msgpack.packb({"vms": ["vm-1"]}, use_bin_type=True))
+
+    affected, _, _ = sweep(redis_server, [expiring, persistent], orphans=["vm-1"])
+
+    assert sorted(affected) == sorted([expiring.encode(), persistent.encode()])
+    assert 990 < redis_server.ttl(expiring) <= 1000
+    assert redis_server.ttl(persistent) == -1
+
+def test_unparseable_and_missing_sessions(redis_server):
+    broken = f"{KEY_PREFIX}broken"
+    missing = f"{KEY_PREFIX}missing"
+    redis_server.set(broken, b'{"vms": ["vm-1"')
+
+    affected, missing_keys, _ = sweep(redis_server, [broken, missing], orphans=["vm-1"])
+
+    assert affected == [] and missing_keys == [missing.encode()]
+    assert redis_server.get(broken) == b'{"vms": ["vm-1"'